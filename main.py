@@ -1,6 +1,7 @@
 import json
 import os
 import re
+import time
 
 from amiyabot import Message, Chain, log
 
@@ -24,7 +25,7 @@ def dynamic_get_global_config_schema_data():
         model_list = bot.model_list()
 
         newValues = ["..."]
-        newValues.extend([model["model_name"] for model in model_list])
+        newValues.extend([model["model_name"] for model in model_list if "chat_flow" in model["supported_feature"]])
 
         try:                        
             data["properties"]["default_model"]["enum"] = newValues
@@ -50,4 +51,17 @@ bot = BLMLibraryPluginInstance(
 async def test_call_lib(data: Message):
     ret = await bot.chat_flow('测试调用库', 'ERNIE-Bot')
     log.info(ret)
-    return Chain(data).text(ret)
\ No newline at end of file
+    return Chain(data).text(ret)
+
+@bot.on_message(keywords=['导出调用量'], level=5)
+async def export_usage(data: Message):
+    if not data.is_admin:
+        return
+    # 例：导出调用量 jsonl 增量
+    export_format = 'jsonl' if 'jsonl' in data.text else 'csv'
+    since_last_export = '增量' in data.text
+    export_dir = f'{curr_dir}/../../resource/blm_library/usage_export'
+    os.makedirs(export_dir, exist_ok=True)
+    file_path = os.path.abspath(f'{export_dir}/usage_{time.strftime("%Y%m%d%H%M%S")}.{export_format}')
+    exported = await bot.export_usage(file_path, export_format, since_last_export=since_last_export)
+    return Chain(data).text(f'已导出{exported}条调用记录到 {file_path}')
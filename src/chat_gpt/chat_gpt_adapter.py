@@ -1,8 +1,6 @@
 
 import time
-import httpx
 
-from openai import AsyncOpenAI,BadRequestError,RateLimitError
 from datetime import datetime
 
 from typing import List, Optional, Union
@@ -13,7 +11,12 @@ from core.util.threadPool import run_in_thread_pool
 from amiyabot.log import LoggerManager
 
 from ..common.database import AmiyaBotBLMLibraryTokenConsumeModel
-from ..common.blm_types import BLMAdapter, BLMFunctionCall
+from ..common.blm_types import BLMAdapter, BLMFunctionCall, BLMTimeoutError, mark_local_rejection, time_left
+from ..common.token_counter import token_counter
+from ..common.token_budget import token_budget
+from ..common.embedding import EmbeddingBatcher, EmbeddingCache, split_usage
+from ..common.key_pool import KeyPool, PooledKey
+from ..common.chat_session import ChatSession, SessionStore
 
 logger = LoggerManager('BLM-ChatGPT')
 
@@ -21,8 +24,12 @@ class ChatGPTAdapter(BLMAdapter):
     def __init__(self, plugin):
         super().__init__()
         self.plugin:AmiyaBotPluginInstance = plugin
-        self.context_holder = {}
+        self.sessions = SessionStore()
         self.query_times = []
+        self.clients = {}
+        self.key_pool = KeyPool([], "api_key")
+        self.key_pool_credentials = []
+        self.embedding_batchers = {}
 
     def debug_log(self, msg):
         show_log = self.plugin.get_config("show_log")
@@ -35,6 +42,107 @@ class ChatGPTAdapter(BLMAdapter):
             return chatgpt_config[key]
         return None
 
+    def __get_key_pool(self) -> KeyPool:
+        # api_key之外，还可以在api_keys中配置更多的key，请求会分散到这些key上
+        api_keys = [self.get_config('api_key')] + (self.get_config('api_keys') or [])
+        credentials = []
+        for api_key in api_keys:
+            if api_key and {"api_key": api_key} not in credentials:
+                credentials.append({"api_key": api_key})
+        if credentials != self.key_pool_credentials:
+            self.key_pool.update(credentials, "api_key")
+            self.key_pool_credentials = credentials
+        return self.key_pool
+
+    def __get_client(self, api_key: str):
+        # 每个key复用同一个客户端，从而复用其中的连接池；相关配置变化时重新创建
+        import httpx
+        from openai import AsyncOpenAI
+
+        proxy = self.get_config('proxy')
+        base_url = self.get_config('url')
+
+        client_key = (api_key, base_url, proxy)
+        client = self.clients.get(client_key)
+        if client is not None:
+            return client
+
+        async_httpx_client = None
+        if proxy is not None and proxy != "":
+            if proxy.startswith("https://"):
+                proxies = {
+                    "http://": proxy,
+                    "https://": proxy
+                }
+                async_httpx_client=httpx.AsyncClient(proxies=proxies)
+            elif proxy.startswith("http://"):
+                proxies = {
+                    "http://": proxy
+                }
+                async_httpx_client=httpx.AsyncClient(proxies=proxies)
+            else:
+                raise ValueError("无效的代理URL")
+
+        client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client = async_httpx_client
+        )
+        self.clients[client_key] = client
+        return client
+
+    def __park_key_on_error(self, key_pool: KeyPool, key: PooledKey, e: Exception):
+        from openai import AuthenticationError,PermissionDeniedError,RateLimitError
+
+        if isinstance(e, RateLimitError):
+            key_pool.park(key, "rate_limit")
+            self.debug_log(f"key {key.name} parked: rate limit")
+        elif isinstance(e, (AuthenticationError, PermissionDeniedError)):
+            key_pool.park(key, "auth")
+            self.debug_log(f"key {key.name} parked: auth error")
+
+    def key_pool_status(self) -> List[dict]:
+        return self.__get_key_pool().status()
+
+    def is_idle(self) -> bool:
+        return self.inflight == 0 and all(batcher.is_idle() for batcher in self.embedding_batchers.values())
+
+    def inherit(self, old_adapter):
+        # 会话、凭据的统计和停用状态与连接无关，直接沿用
+        self.sessions = old_adapter.sessions
+        self.query_times = old_adapter.query_times
+        self.key_pool = old_adapter.key_pool
+
+        # key、url和proxy都没有变化的客户端直接接过来，旧适配器关闭时只会关闭其余的连接池
+        base_url = self.get_config('url')
+        proxy = self.get_config('proxy')
+        api_keys = {key.credential["api_key"] for key in self.__get_key_pool().keys}
+        for client_key in list(old_adapter.clients.keys()):
+            api_key, client_base_url, client_proxy = client_key
+            if api_key in api_keys and client_base_url == base_url and client_proxy == proxy:
+                self.clients[client_key] = old_adapter.clients.pop(client_key)
+
+        # 向量化的批处理器连同排队中的文本和缓存一起接过来，之后的批次由新适配器发送
+        for model, batcher in old_adapter.embedding_batchers.items():
+            batcher.embed_batch = self.__embed_batch_function(model)
+        self.embedding_batchers = old_adapter.embedding_batchers
+        old_adapter.embedding_batchers = {}
+
+    async def close(self):
+        for client in self.clients.values():
+            await client.close()
+        self.clients = {}
+        for batcher in self.embedding_batchers.values():
+            batcher.cache.close()
+
+    async def warm_up(self) -> dict:
+        # 为每个key创建客户端并请求一次模型列表，提前完成DNS解析和TCP/TLS握手
+        start_time = time.monotonic()
+        for key in self.__get_key_pool().keys:
+            client = self.__get_client(key.credential["api_key"])
+            await client.models.list()
+        return {"connection": f"{(time.monotonic() - start_time) * 1000:.0f}ms"}
+
     def __quota_check(self,peek:bool = False) -> int:
         query_per_hour = self.get_config('high_cost_quota')
 
@@ -81,7 +189,87 @@ class ChatGPTAdapter(BLMAdapter):
         if disable_high_cost != True:
             model_list_response.append({"model_name": "gpt-4", "type": "high-cost", "max-token":4000, "supported_feature": [
                 "completion_flow", "chat_flow", "assistant_flow", "function_call"]})
+        model_list_response.append({"model_name": "text-embedding-ada-002", "type": "low-cost", "max-token":8191, "supported_feature": [
+            "embedding_flow"]})
         return model_list_response
+
+    def __embed_batch_function(self, model: str):
+        return lambda batch, batch_channel_ids: self.__embed_batch(model, batch, batch_channel_ids)
+
+    async def __embed_batch(self, model: str, texts: List[str], channel_ids: List[Optional[str]]) -> Optional[List[List[float]]]:
+        # 批次在后台发送，调用方超时后也可能仍在进行，计入inflight，适配器被替换后要等它结束才关闭连接
+        self.inflight += 1
+        try:
+            return await self.__send_embed_batch(model, texts, channel_ids)
+        finally:
+            self.inflight -= 1
+
+    async def __send_embed_batch(self, model: str, texts: List[str], channel_ids: List[Optional[str]]) -> Optional[List[List[float]]]:
+        key_pool = self.__get_key_pool()
+        key = key_pool.acquire()
+        if key is None:
+            self.debug_log('all api keys are parked')
+            return None
+
+        try:
+            client = self.__get_client(key.credential["api_key"])
+            response = await client.embeddings.create(model=model, input=texts)
+        except Exception as e:
+            self.debug_log(f"embedding Exception: {e}")
+            self.__park_key_on_error(key_pool, key, e)
+            return None
+        finally:
+            key_pool.release(key)
+
+        key_pool.record_usage(key, int(response.usage.prompt_tokens), 0, int(response.usage.total_tokens))
+
+        vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+        # 批次中的文本可能来自多个频道，每个频道按分摊到的用量各记一行
+        prompt_shares = split_usage(texts, channel_ids, int(response.usage.prompt_tokens))
+        total_shares = split_usage(texts, channel_ids, int(response.usage.total_tokens))
+        for channel_id, total_tokens in total_shares.items():
+            usage_row = AmiyaBotBLMLibraryTokenConsumeModel.create(
+                channel_id=channel_id if channel_id is not None else "-", model_name=model, exec_id="-",
+                prompt_tokens=prompt_shares[channel_id],
+                completion_tokens=0,
+                total_tokens=total_tokens, exec_time=datetime.now())
+            # 写入数据库之后再计入预算，对账时按行号去重
+            token_budget.record(channel_id, model, total_tokens, usage_row.id)
+
+        return vectors
+
+    async def embedding_flow(
+        self,
+        texts: Union[str, List[str]],
+        model: Optional[Union[str, dict]] = None,
+        channel_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[List[List[float]]]:
+        model_info = self.get_model(model)
+        if model_info is None or "embedding_flow" not in model_info["supported_feature"]:
+            self.debug_log(f'model {model} not supported embedding_flow')
+            mark_local_rejection("unsupported")
+            return None
+
+        if not self.__get_key_pool().has_available():
+            self.debug_log('all api keys are parked')
+            mark_local_rejection("keys_parked")
+            return None
+
+        if isinstance(texts, str):
+            texts = [texts]
+
+        batcher = self.embedding_batchers.get(model)
+        if batcher is None:
+            # OpenAI单次最多支持2048条，这里取一个较小的值以控制单次请求的大小
+            batcher = EmbeddingBatcher(EmbeddingCache(self.cache_dir, model),
+                                       self.__embed_batch_function(model),
+                                       max_batch=256,
+                                       request_timeout=self.plugin.get_config("timeout") or None)
+            self.embedding_batchers[model] = batcher
+
+        return await batcher.embed(texts, channel_id, deadline)
     
     async def chat_flow(  
         self,  
@@ -90,6 +278,8 @@ class ChatGPTAdapter(BLMAdapter):
         context_id: Optional[str] = None,  
         channel_id: Optional[str] = None,
         functions: Optional[List[BLMFunctionCall]] = None,  
+        deadline: Optional[float] = None,
+        ephemeral_prompt: Optional[List[str]] = None,
     ) -> Optional[str]:  
         
         self.debug_log(f'chat_flow received: {prompt} {model} {context_id} {channel_id} {functions}')
@@ -97,72 +287,92 @@ class ChatGPTAdapter(BLMAdapter):
         model_info = self.get_model(model)
         if model_info is None:
             self.debug_log('model not found')
+            mark_local_rejection("unsupported")
             return None
         
         self.debug_log(f'model info: {model_info}')
 
         if not model_info["supported_feature"].__contains__("chat_flow"):
             self.debug_log('model not supported chat_flow')
+            mark_local_rejection("unsupported")
             return None
         if model_info["type"] == "high-cost":
             quota = self.__quota_check()
             if quota <= 0:
                 self.debug_log(f"quota check failed, fallback to gpt-3.5-turbo {quota}")
+                # 实际请求的是另一个模型，结果不能算在原模型头上
+                mark_local_rejection("quota")
                 model_info = self.get_model("gpt-3.5-turbo")
 
         proxy = self.get_config('proxy')
-        async_httpx_client = None
-        if proxy is not None and proxy != "":
-            if proxy.startswith("https://"):
-                proxies = {
-                    "http://": proxy,
-                    "https://": proxy
-                }
-                async_httpx_client=httpx.AsyncClient(proxies=proxies)
-            elif proxy.startswith("http://"):
-                proxies = {
-                    "http://": proxy
-                }
-                async_httpx_client=httpx.AsyncClient(proxies=proxies)
-            else:
-                raise ValueError("无效的代理URL")
-
         base_url = self.get_config('url')
-        client = AsyncOpenAI(
-            api_key=self.get_config('api_key'),
-            base_url=base_url,
-            http_client = async_httpx_client
-        )
 
         self.debug_log(f"url: {base_url} proxy: {proxy} model: {model_info}")
         
         if isinstance(prompt, str):
             prompt = [prompt]
         
-        prompt = [{"role": "user", "content": command} for command in prompt]
-        
-        if context_id is not None:
-            if context_id not in self.context_holder:
-                self.context_holder[context_id] = []
-            prompt = self.context_holder[context_id] + prompt
+        new_messages = [{"role": "user", "content": command} for command in prompt]
+        ephemeral_messages = [{"role": "user", "content": command} for command in ephemeral_prompt or []]
+
+        # 同一个context的请求按顺序执行，避免并发时互相覆盖对话记录
+        session = self.sessions.get(context_id)
+        async with session.lock:
+            return await self.__send_chat(model_info, session, ephemeral_messages, new_messages, channel_id, deadline)
+
+    async def __send_chat(self, model_info: dict, session: ChatSession, ephemeral_messages: List[dict], new_messages: List[dict],
+                          channel_id: Optional[str], deadline: Optional[float]) -> Optional[str]:
+        # openai的导入比较耗时，推迟到第一次调用时
+        from openai import APITimeoutError,BadRequestError,RateLimitError
+
+        # 发送前先离线估算token，超过max-token的历史从前往后丢弃，
+        # 如果本次提交本身就超限，就不必再去请求服务器了
+        # ephemeral_messages只随本次请求发送，不写入会话
+        prompt = session.window(ephemeral_messages + new_messages, model_info["max-token"], model_info["model_name"])
+        if prompt is None:
+            self.debug_log(f'prompt exceeds max-token of {model_info["model_name"]}')
+            mark_local_rejection("max_token")
+            return None
+
+        estimated_tokens = token_counter.count_raw(prompt)
 
         combined_message = ''.join(obj['content'] for obj in prompt)
 
+        key_pool = self.__get_key_pool()
+        key = key_pool.acquire()
+        if key is None:
+            self.debug_log('all api keys are parked')
+            mark_local_rejection("keys_parked")
+            return None
+
+        self.debug_log(f"use api key: {key.name}")
+
         try:
-            completions = await client.chat.completions.create(model=model_info["model_name"],messages=prompt)
+            client = self.__get_client(key.credential["api_key"])
+            completions = await client.chat.completions.create(model=model_info["model_name"],messages=prompt,
+                                                               timeout=time_left(deadline))
                         
+        except APITimeoutError as e:
+            self.debug_log(f"APITimeoutError: {e}")
+            raise BLMTimeoutError(f"{model_info['model_name']} timed out") from e
         except RateLimitError as e:
             self.debug_log(f"RateLimitError: {e}")
             self.debug_log(f'Chatgpt Raw: \n{combined_message}')
+            self.__park_key_on_error(key_pool, key, e)
             return None
         except BadRequestError as e:
+            # 请求本身有问题，服务商是正常的
             self.debug_log(f"BadRequestError: {e}")
             self.debug_log(f'Chatgpt Raw: \n{combined_message}')
+            mark_local_rejection("bad_request")
             return None
         except Exception as e:
             self.debug_log(f"Exception: {e}")
             self.debug_log(f'Chatgpt Raw: \n{combined_message}')
+            self.__park_key_on_error(key_pool, key, e)
             return None
+        finally:
+            key_pool.release(key)
 
         text: str = completions.choices[0].message.content
         # role: str = completions.choices[0].message.role
@@ -192,14 +402,17 @@ class ChatGPTAdapter(BLMAdapter):
         if channel_id is None:
             channel_id = "-"
 
-        AmiyaBotBLMLibraryTokenConsumeModel.create(
+        token_counter.calibrate(model_info["model_name"], estimated_tokens, int(usage.prompt_tokens))
+        key_pool.record_usage(key, int(usage.prompt_tokens), int(usage.completion_tokens), int(usage.total_tokens))
+
+        usage_row = AmiyaBotBLMLibraryTokenConsumeModel.create(
             channel_id=channel_id, model_name=model_info["model_name"], exec_id=id,
             prompt_tokens=int(usage.prompt_tokens),
             completion_tokens=int(usage.completion_tokens),
             total_tokens=int(usage.total_tokens), exec_time=datetime.now())
+        # 写入数据库之后再计入预算，对账时按行号去重
+        token_budget.record(channel_id, model_info["model_name"], int(usage.total_tokens), usage_row.id)
 
-        if context_id is not None:
-            prompt.append({"role": "assistant", "content": text})
-            self.context_holder[context_id] = prompt
+        session.append_turn(new_messages + [{"role": "assistant", "content": text}])
 
         return f"{text}".strip()
\ No newline at end of file
@@ -0,0 +1,20 @@
+import importlib
+import time
+from typing import Dict, Tuple, Type
+
+from .blm_types import BLMAdapter
+
+# 按配置节的名字注册适配器，只有在该配置节启用时才会导入对应的模块，
+# 这样没有启用的服务商不会在启动时加载它的SDK。
+ADAPTER_REGISTRY: Dict[str, Tuple[str, str]] = {
+    "ChatGPT": ("..chat_gpt.chat_gpt_adapter", "ChatGPTAdapter"),
+    "ERNIE": ("..ernie.ernie_adapter", "ERNIEAdapter"),
+}
+
+
+def load_adapter_class(name: str) -> Tuple[Type[BLMAdapter], float]:
+    # 返回适配器类以及导入耗时（秒）
+    module_name, class_name = ADAPTER_REGISTRY[name]
+    start_time = time.perf_counter()
+    module = importlib.import_module(module_name, package=__package__)
+    return getattr(module, class_name), time.perf_counter() - start_time
@@ -1,16 +1,37 @@
 import asyncio
+import functools
 import json
+import time
+from datetime import datetime
 from typing import Any, Dict, List, Optional, Union
 
 from core import AmiyaBotPluginInstance,Requirement
 from core.plugins.customPluginInstance.amiyaBotPluginInstance import CONFIG_TYPE,DYNAMIC_CONFIG_TYPE
 
-from ..common.blm_types import BLMAdapter, BLMFunctionCall
-from ..chat_gpt.chat_gpt_adapter import ChatGPTAdapter 
-from ..ernie.ernie_adapter import ERNIEAdapter 
+from core.util.threadPool import run_in_thread_pool
+
+from amiyabot.log import LoggerManager
+
+from ..common.blm_types import BLMAdapter, BLMCallOutcome, BLMFunctionCall, BLMTimeoutError, current_call_outcome, dir_path, ensure_cache_dir, time_left
 from ..common.database import AmiyaBotBLMLibraryTokenConsumeModel,AmiyaBotBLMLibraryMetaStorageModel
 
+from .adapter_registry import ADAPTER_REGISTRY, load_adapter_class
 from .extract_json import extract_json
+from .token_counter import token_counter
+from .model_router import ModelRouter
+from .circuit_breaker import CircuitBreaker
+from .embedding import content_hash
+from .vector_index import VectorIndex, numpy_available
+from .usage_export import export_usage
+from .token_budget import token_budget
+
+logger = LoggerManager('BLM-Library')
+
+# 每次检索最多取回的分块数量
+RETRIEVAL_TOP_K = 8
+
+# 检查配置变化的最小间隔（秒）
+CONFIG_CHECK_INTERVAL = 5
 
 class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
     def __init__(self, name: str, 
@@ -28,45 +49,225 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
                  global_config_schema: DYNAMIC_CONFIG_TYPE = None, 
                  deprecated_config_delete_days: int = 7):
         super().__init__(name, version, plugin_id, plugin_type, description, document, priority, instruction, requirements, channel_config_default, channel_config_schema, global_config_default, global_config_schema, deprecated_config_delete_days)
-        self.adapters: List[BLMAdapter] = []
+        self.adapters: Dict[str,BLMAdapter] = {}
+        self.startup_report: Dict[str,float] = {}
+        self.warm_up_report: Dict[str,Any] = {}
+        self.warm_up_task: Optional[asyncio.Task] = None
+        self.assistants: Dict[str,dict] = {}
+        self.breakers: Dict[str,CircuitBreaker] = {}
         self.model_map: Dict[str,BLMAdapter] = {}
+        self.router = ModelRouter()
+        self.config_fingerprints: Dict[str,Optional[str]] = {}
+        self.config_check_time = 0.0
+        self.budget_reconcile_task: Optional[asyncio.Task] = None
 
     def install(self):
-        
+        install_start_time = time.perf_counter()
+
+        ensure_cache_dir()
+
         AmiyaBotBLMLibraryTokenConsumeModel.create_table(safe=True)
         AmiyaBotBLMLibraryMetaStorageModel.create_table(safe=True)
 
-        # 读取配置文件来确定各个模型是不是启用
-        chatgpt_config = self.get_config("ChatGPT")
-        if chatgpt_config and chatgpt_config["enable"]:
-            self.adapters.append(ChatGPTAdapter(self))
-        ernie_config = self.get_config("ERNIE")
-        if ernie_config and ernie_config["enable"]:
-            self.adapters.append(ERNIEAdapter(self))
+        token_counter.load_calibration()
+
+        # 从数据库汇总当天的用量，作为预算的初始值
+        try:
+            token_budget.seed()
+        except Exception as e:
+            logger.info(f"failed to seed token budget: {e}")
+
+        # 读取配置文件来确定各个模型是不是启用，只有启用的适配器才会被导入
+        self.__check_config(force=True)
         
-        self.model_list()
+        self.__all_models()
+
+        self.startup_report["total"] = time.perf_counter() - install_start_time
+        report = ", ".join(f"{key}: {value * 1000:.1f}ms" for key, value in self.startup_report.items())
+        logger.info(f"startup timing: {report}")
+
+        # 在后台预热，不阻塞插件加载
+        if self.get_config("warm_up") != False:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                loop = asyncio.get_event_loop()
+            self.warm_up_task = loop.create_task(self.warm_up())
+
+    def uninstall(self):
+        token_counter.flush_calibration()
+        super().uninstall()
+
+    async def warm_up(self) -> dict:
+        report = {}
+
+        model_list = self.__all_models()
+        report["model_registry"] = len(model_list)
+
+        # 各个适配器同时预热，每个都受配置的超时限制，一个服务商卡住不会拖慢其他服务商
+        async def warm_up_adapter(adapter_name: str, adapter: BLMAdapter):
+            try:
+                report[adapter_name] = await asyncio.wait_for(adapter.warm_up(), time_left(self.__get_deadline(None)))
+            except asyncio.TimeoutError:
+                report[adapter_name] = {"error": "timeout"}
+            except Exception as e:
+                report[adapter_name] = {"error": f"{e}"}
+
+        await asyncio.gather(*[warm_up_adapter(adapter_name, adapter) for adapter_name, adapter in list(self.adapters.items())])
+
+        # 可选的探测请求：向每个适配器最便宜的模型发一句很短的话，测量基准延迟
+        if self.get_config("warm_up_probe") == True:
+            for adapter_name, adapter in self.adapters.items():
+                probe_model = next((model_info["model_name"] for model_info in adapter.model_list()
+                                    if model_info["type"] == "low-cost" and "chat_flow" in model_info["supported_feature"]), None)
+                if probe_model is None:
+                    continue
+                start_time = time.monotonic()
+                try:
+                    result = await self.__timed_call(probe_model, adapter, adapter.chat_flow("hi", probe_model, None, "blm-warm-up"), self.__get_deadline(None))
+                except BLMTimeoutError:
+                    result = None
+                report.setdefault(adapter_name, {})["probe"] = \
+                    f"{probe_model} {(time.monotonic() - start_time) * 1000:.0f}ms" if result is not None else f"{probe_model} failed"
+
+        self.warm_up_report = report
+        logger.info(f"warm up finished: {report}")
+        return report
+
+    def __fingerprint(self, key: str) -> Optional[str]:
+        config = self.get_config(key)
+        if config is None:
+            return None
+        return json.dumps(config, sort_keys=True, ensure_ascii=False)
+
+    def __check_config(self, force: bool = False):
+        # 配置变化时，只重建配置发生变化的适配器，其他适配器保持不动
+        now = time.monotonic()
+        if not force and now - self.config_check_time < CONFIG_CHECK_INTERVAL:
+            return
+        self.config_check_time = now
+
+        changed = False
+
+        breaker_fingerprint = self.__fingerprint("circuit_breaker")
+        if breaker_fingerprint != self.config_fingerprints.get("circuit_breaker"):
+            self.config_fingerprints["circuit_breaker"] = breaker_fingerprint
+            self.breakers = {}
+
+        for adapter_name in ADAPTER_REGISTRY:
+            adapter_config = self.get_config(adapter_name)
+            fingerprint = self.__fingerprint(adapter_name) if adapter_config and adapter_config["enable"] else None
+            if adapter_name in self.config_fingerprints and fingerprint == self.config_fingerprints[adapter_name]:
+                continue
+            self.config_fingerprints[adapter_name] = fingerprint
+
+            old_adapter = self.adapters.pop(adapter_name, None)
+            if fingerprint is not None:
+                new_adapter = self.__load_adapter(adapter_name)
+                if old_adapter is not None:
+                    new_adapter.inherit(old_adapter)
+                self.adapters[adapter_name] = new_adapter
+
+            if old_adapter is not None:
+                # 新配置可能已经修复了问题，清除旧适配器的模型的熔断状态
+                for model_name, adapter in self.model_map.items():
+                    if adapter is old_adapter:
+                        self.breakers.pop(model_name, None)
+                self.__retire_adapter(old_adapter)
+                logger.info(f"{adapter_name} config changed, adapter {'reloaded' if fingerprint else 'unloaded'}")
+
+            changed = True
+
+        if changed:
+            self.__build_model_list()
+            self.router.invalidate()
+
+    def __retire_adapter(self, adapter: BLMAdapter):
+        # 旧适配器上正在进行的请求（包括排队中的向量化批次）在后台完成后，再关闭它的连接池
+        async def drain():
+            while not adapter.is_idle():
+                await asyncio.sleep(1)
+            await adapter.close()
+
+        try:
+            asyncio.get_running_loop().create_task(drain())
+        except RuntimeError:
+            pass
+
+    def __load_adapter(self, adapter_name: str) -> BLMAdapter:
+        adapter_class, import_time = load_adapter_class(adapter_name)
+        create_start_time = time.perf_counter()
+        adapter = adapter_class(self)
+        self.startup_report[adapter_name] = import_time + time.perf_counter() - create_start_time
+        return adapter
 
     def model_list(self) -> List[dict]:  
+        # 对外的模型列表只包含对话类模型，其他插件会用它让用户选择对话模型；
+        # 向量模型通过embedding_model_list获取
+        return [model for model in self.__all_models() if "embedding_flow" not in model["supported_feature"]]
+
+    def embedding_model_list(self) -> List[dict]:
+        return [model for model in self.__all_models() if "embedding_flow" in model["supported_feature"]]
+
+    def __all_models(self) -> List[dict]:
+        self.__check_config()
+        return self.__build_model_list()
+
+    def __build_model_list(self) -> List[dict]:
         # 返回的同时，构造ModelMap，方便后续的模型调用
         model_list = []
-        for adapter in self.adapters:
+        model_map = {}
+        for adapter in self.adapters.values():
             adapter_models = adapter.model_list()
             model_list.extend(adapter_models)
             for model in adapter_models:
-                self.model_map[model["model_name"]] = adapter
+                model_map[model["model_name"]] = adapter
+        self.model_map = model_map
         return model_list
     
+    def __get_adapter(self, model_name: str) -> Optional[BLMAdapter]:
+        self.__check_config()
+        return self.model_map.get(model_name)
+
     def get_model(self,model_name:str)->dict:
-        model_dict_list = self.model_list()
+        model_dict_list = self.__all_models()
         for model_dict in model_dict_list:
             if model_dict["model_name"] == model_name:
                 return model_dict
 
     def get_model_quota_left(self,model_name:str) -> int:
-        adapter = self.model_map[model_name]
-        if not adapter:
+        if model_name not in self.model_map:
             return 0
-        return adapter.get_model_quota_left(model_name)
+        # 熔断中的模型视为没有配额，调用方可以据此提前跳过
+        if not self.__is_model_available(model_name):
+            return 0
+        return self.__get_adapter_quota_left(model_name)
+
+    def __get_breaker(self, model_name: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model_name)
+        if breaker is None:
+            breaker_config = self.get_config("circuit_breaker") or {}
+            breaker = CircuitBreaker(model_name,
+                                     failure_threshold=breaker_config.get("failures") or 5,
+                                     error_rate_threshold=breaker_config.get("error_rate") or 0.5,
+                                     cooldown=breaker_config.get("cooldown") or 30,
+                                     on_state_change=self.__on_breaker_state_change)
+            self.breakers[model_name] = breaker
+        return breaker
+
+    def __on_breaker_state_change(self, model_name: str, old_state: str, new_state: str):
+        logger.info(f"circuit breaker of {model_name}: {old_state} -> {new_state}")
+
+    def get_model_health(self, model_name: str) -> dict:
+        # 模型的熔断状态，以及路由使用的延迟和错误率估计
+        health = self.__get_breaker(model_name).status()
+        stats = self.router.stats.get(model_name)
+        health["latency"] = round(stats.latency, 3) if stats is not None and stats.samples > 0 else None
+        return health
+
+    def get_key_pool_status(self) -> Dict[str,List[dict]]:
+        # 每个服务商各个凭据的未完成请求数、停用状态和token消耗
+        return {adapter_name: adapter.key_pool_status() for adapter_name, adapter in self.adapters.items()}
 
     def get_default_model(self) -> dict:
         default_model = self.get_config("default_model")
@@ -75,6 +276,111 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
         else:
             return None
 
+    def route_model(self, feature: str, prompt: Union[str, List[str], None] = None) -> Optional[dict]:
+        # 在启用的模型中，挑选一个配额充足、足够健康、延迟最低的模型
+        # 剩余配额随候选列表一起缓存，每次调用只检查熔断状态
+        prompt_tokens = token_counter.count_tokens(prompt) if prompt else 0
+        return self.router.pick(self.__all_models, feature, prompt_tokens, self.__get_adapter_quota_left, self.__is_model_available)
+
+    def __get_adapter_quota_left(self, model_name: str) -> int:
+        adapter = self.model_map.get(model_name)
+        if not adapter:
+            return 0
+        return adapter.get_model_quota_left(model_name)
+
+    def __is_model_available(self, model_name: str) -> bool:
+        return self.__get_breaker(model_name).is_available()
+
+    def __resolve_model(self, model: Optional[Union[str, dict]], feature: str, prompt: Union[str, List[str], None] = None) -> Optional[str]:
+        if model is None:
+            if self.get_config("model_router") == True:
+                model = self.route_model(feature, prompt)
+            else:
+                model = self.get_default_model()
+
+        if isinstance(model,dict):
+            model = model["model_name"]
+
+        return model
+
+    def __get_deadline(self, timeout: Optional[float]) -> Optional[float]:
+        # 没有传入timeout时使用配置中的默认超时，0表示不限
+        if timeout is None:
+            timeout = self.get_config("timeout")
+        if not timeout or timeout <= 0:
+            return None
+        return time.monotonic() + timeout
+
+    def __apply_budget(self, model: Optional[str], channel_id: Optional[str], prompt) -> Optional[str]:
+        # 在发出请求前检查频道预算，超出时降级到配置的模型，没有可降级的模型则拒绝
+        if model is None:
+            return None
+
+        token_budget.set_budgets(self.get_config("token_budget"))
+        if not token_budget.budgets:
+            return model
+
+        if token_budget.need_reconcile() and (self.budget_reconcile_task is None or self.budget_reconcile_task.done()):
+            self.budget_reconcile_task = asyncio.create_task(self.__reconcile_budget())
+
+        prompt_tokens = token_counter.count_tokens(prompt, model) if prompt else 0
+        allowed_model, budget = token_budget.check(channel_id, model, prompt_tokens)
+        if allowed_model is None:
+            logger.info(f"channel {channel_id} exceeds token budget {budget}, request rejected")
+        elif allowed_model != model:
+            logger.info(f"channel {channel_id} exceeds token budget of {model}, downgrade to {allowed_model}")
+        return allowed_model
+
+    async def __reconcile_budget(self):
+        token_budget.begin_reconcile()
+        totals = None
+        try:
+            totals = await run_in_thread_pool(token_budget.load_totals)
+        except Exception as e:
+            logger.info(f"failed to reconcile token budget: {e}")
+        finally:
+            token_budget.finish_reconcile(totals)
+
+    def get_token_budget_status(self, channel_id: Optional[str] = None) -> List[dict]:
+        # 当天各个频道、各个模型的累计用量
+        return [item for item in token_budget.status() if channel_id is None or item["channel_id"] == channel_id]
+
+    async def __timed_call(self, model: str, adapter: BLMAdapter, coroutine, deadline: Optional[float] = None,
+                           raise_timeout: bool = False):
+        # 记录每次调用的耗时和成败，供模型路由使用
+        # 到达deadline时取消正在进行的请求。调用方显式传入了timeout时抛出BLMTimeoutError，
+        # 否则和其他失败一样返回None，不改变老插件所依赖的返回约定
+        # 熔断中的模型直接失败，不经过网络
+        # 适配器标记为本地拒绝的调用不计入熔断器和路由的统计
+        breaker = self.__get_breaker(model)
+        ticket = breaker.allow()
+        if ticket is None:
+            coroutine.close()
+            return None
+
+        start_time = time.monotonic()
+        result = None
+        outcome = BLMCallOutcome()
+        outcome_token = current_call_outcome.set(outcome)
+        adapter.inflight += 1
+        try:
+            result = await asyncio.wait_for(coroutine, time_left(deadline))
+            return result
+        except asyncio.TimeoutError as e:
+            message = f"{model} timed out after {time.monotonic() - start_time:.1f}s"
+            if raise_timeout:
+                raise BLMTimeoutError(message) from e
+            logger.info(message)
+            return None
+        finally:
+            adapter.inflight -= 1
+            current_call_outcome.reset(outcome_token)
+            if outcome.rejected is not None:
+                breaker.release(ticket)
+            else:
+                self.router.record(model, time.monotonic() - start_time, result is not None)
+                breaker.record(ticket, result is not None)
+
     # 以下是对外提供的接口, 通过model_name来确定调用哪个模型
 
     async def completion_flow(  
@@ -83,17 +389,17 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
         model: Optional[Union[str, dict]] = None,
         context_id: Optional[str] = None,
         channel_id: Optional[str] = None,
+        timeout: Optional[float] = None,
     ) -> Optional[str]:  
-        if model is None:
-            model = self.get_default_model()
-            
-        if isinstance(model,dict):
-            model = model["model_name"]
+        deadline = self.__get_deadline(timeout)
+        model = self.__resolve_model(model, "completion_flow", prompt)
+        model = self.__apply_budget(model, channel_id, prompt)
 
-        adapter = self.model_map[model]
+        adapter = self.__get_adapter(model)
         if not adapter:
             return None
-        return await adapter.completion_flow(prompt, model, context_id, channel_id)
+        return await self.__timed_call(model, adapter, adapter.completion_flow(prompt, model, context_id, channel_id, deadline), deadline,
+                                       timeout is not None)
 
     async def chat_flow(  
         self,  
@@ -102,17 +408,51 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
         context_id: Optional[str] = None,  
         channel_id: Optional[str] = None,
         functions: Optional[List[BLMFunctionCall]] = None,  
+        timeout: Optional[float] = None,
     ) -> Optional[str]:
-        if model is None:
-            model = self.get_default_model()
+        return await self.__chat_flow(prompt, model, context_id, channel_id, functions,
+                                      self.__get_deadline(timeout), timeout is not None)
+
+    async def __chat_flow(self, prompt: Union[str, List[str]], model: Optional[Union[str, dict]], context_id: Optional[str],
+                          channel_id: Optional[str], functions: Optional[List[BLMFunctionCall]],
+                          deadline: Optional[float], raise_timeout: bool,
+                          ephemeral_prompt: Optional[List[str]] = None) -> Optional[str]:
+        # 内部调用直接传递绝对的deadline，避免剩余时间为0时被当成不限时
+        # ephemeral_prompt随本次请求发送，但不会写入会话
+        model = self.__resolve_model(model, "chat_flow", prompt)
+        budget_prompt = (ephemeral_prompt or []) + ([prompt] if isinstance(prompt, str) else list(prompt))
+        model = self.__apply_budget(model, channel_id, budget_prompt)
 
+        adapter = self.__get_adapter(model)
+        if not adapter:
+            return None
+        return await self.__timed_call(model, adapter,
+                                       adapter.chat_flow(prompt, model, context_id, channel_id, functions, deadline, ephemeral_prompt),
+                                       deadline, raise_timeout)
+
+    async def embedding_flow(
+        self,
+        texts: Union[str, List[str]],
+        model: Optional[Union[str, dict]] = None,
+        channel_id: Optional[str] = None,
+        timeout: Optional[float] = None,
+    ) -> Optional[List[List[float]]]:
+        return await self.__embedding_flow(texts, model, channel_id, self.__get_deadline(timeout), timeout is not None)
+
+    async def __embedding_flow(self, texts: Union[str, List[str]], model: Optional[Union[str, dict]], channel_id: Optional[str],
+                               deadline: Optional[float], raise_timeout: bool) -> Optional[List[List[float]]]:
+        # 默认模型是对话模型，因此不提供模型时总是自动选择一个向量模型
+        if model is None:
+            model = self.route_model("embedding_flow")
         if isinstance(model,dict):
             model = model["model_name"]
-            
-        adapter = self.model_map[model]
+        model = self.__apply_budget(model, channel_id, texts)
+
+        adapter = self.__get_adapter(model)
         if not adapter:
             return None
-        return await adapter.chat_flow(prompt, model, context_id, channel_id, functions)
+        return await self.__timed_call(model, adapter, adapter.embedding_flow(texts, model, channel_id, deadline), deadline,
+                                       raise_timeout)
 
     async def assistant_flow(  
         self,  
@@ -120,17 +460,51 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
         prompt: Union[str, List[str]],  
         context_id: Optional[str] = None,        
         channel_id: Optional[str] = None,
+        timeout: Optional[float] = None,
     ) -> Optional[str]:
-        if model is None:
-            model = self.get_default_model()
+        deadline = self.__get_deadline(timeout)
+        raise_timeout = timeout is not None
 
-        if isinstance(model,dict):
-            model = model["model_name"]
-
-        adapter = self.model_map[assistant]
-        if not adapter:
+        assistant_info = self.assistants.get(assistant)
+        if assistant_info is None:
             return None
-        return await adapter.assistant_flow(assistant, prompt, context_id, channel_id)
+
+        if isinstance(prompt, str):
+            prompt = [prompt]
+
+        # 把助手的指令和检索到的资料放在本次提交的最前面。
+        # 它们每次都重新检索，只随本次请求发送，不写入对话记录，否则历史里会堆满过期的资料
+        header = assistant_info["instructions"]
+        if assistant_info["index"] is not None:
+            references = await self.__retrieve(assistant_info, prompt, header, deadline, raise_timeout)
+            if references:
+                header = header + "\n以下是可供参考的资料：\n" + "\n\n".join(references)
+
+        return await self.__chat_flow(list(prompt), assistant_info["model"], context_id, channel_id,
+                                      assistant_info["functions"], deadline, raise_timeout, [header])
+
+    async def __retrieve(self, assistant_info: dict, prompt: List[str], instructions: str, deadline: Optional[float],
+                         raise_timeout: bool) -> List[str]:
+        index: VectorIndex = assistant_info["index"]
+
+        query_vectors = await self.__embedding_flow(["\n".join(prompt)], index.model, None, deadline, raise_timeout)
+        if not query_vectors:
+            return []
+
+        # 检索到的资料最多占用模型max-token的一半，剩下的留给对话历史和回复
+        model_info = self.get_model(assistant_info["model"])
+        if model_info is None:
+            return []
+        budget = model_info["max-token"] // 2 - token_counter.count_tokens(prompt + [instructions], assistant_info["model"])
+
+        references = []
+        for chunk, _ in index.search(query_vectors[0], RETRIEVAL_TOP_K):
+            chunk_tokens = token_counter.count_message_tokens(chunk, assistant_info["model"])
+            if chunk_tokens > budget:
+                break
+            references.append(chunk)
+            budget -= chunk_tokens
+        return references
     
     async def assistant_create(  
         self,  
@@ -142,17 +516,72 @@ class BLMLibraryPluginInstance(AmiyaBotPluginInstance,BLMAdapter):
         retrieval: Optional[List[str]] = None,  
     ) -> str:
         
-        if model is None:
-            model = self.get_default_model()
-        if isinstance(model,dict):
-            model = model["model_name"]
-            
-        adapter = self.model_map[model]
-        if not adapter:
+        model = self.__resolve_model(model, "chat_flow")
+
+        if not self.__get_adapter(model):
             return None
-        return await adapter.assistant_create(name, instructions, model, functions, code_interpreter, retrieval)
+
+        assistant_id = "blm-assistant-" + content_hash(name)[:16]
+
+        # 对检索资料建立本地向量索引，索引保存在缓存目录中，文档不变时重复创建几乎没有开销
+        index = None
+        if retrieval:
+            if not numpy_available():
+                logger.info("numpy is not installed, retrieval is disabled")
+            else:
+                embedding_model = self.route_model("embedding_flow")
+                if embedding_model is not None:
+                    embedding_model = embedding_model["model_name"]
+                    # 重复创建同一个助手时沿用已有的索引对象，重建前它会释放对旧文件的内存映射
+                    existing = self.assistants.get(assistant_id)
+                    if existing is not None and existing["index"] is not None:
+                        index = existing["index"]
+                    else:
+                        index = VectorIndex(f"{dir_path}/retrieval/{assistant_id}")
+                    # 整个资料库的向量化不受默认超时限制，单个批次的请求仍有各自的超时
+                    # 建立索引失败（超时、磁盘写入失败、服务商返回了异常的向量等）时，助手仍然可用，只是不带检索
+                    try:
+                        built = await index.build(retrieval, embedding_model,
+                                                  lambda texts: self.__embedding_flow(texts, embedding_model, name, None, False))
+                    except Exception as e:
+                        logger.info(f"error while building retrieval index for assistant {name}: {e}")
+                        built = False
+                    if not built:
+                        logger.info(f"fail to build retrieval index for assistant {name}")
+                        index = None
+
+        self.assistants[assistant_id] = {
+            "name": name,
+            "instructions": instructions,
+            "model": model,
+            "functions": functions,
+            "index": index,
+        }
+        return assistant_id
     
     def extract_json(self, string: str) -> List[Union[Dict[str, Any], List[Any]]]:
         return extract_json(string)
+
+    def count_tokens(self, messages: Union[str, dict, List[Union[str, dict]]], model: Optional[Union[str, dict]] = None) -> int:
+        if isinstance(model,dict):
+            model = model["model_name"]
+        return token_counter.count_tokens(messages, model)
+
+    async def export_usage(self, file_path: str,
+                           export_format: str = "csv",
+                           channel_id: Optional[str] = None,
+                           model: Optional[Union[str, dict]] = None,
+                           start_time: Optional[datetime] = None,
+                           end_time: Optional[datetime] = None,
+                           since_last_export: bool = False,
+                           checkpoint_name: str = "default") -> int:
+        # 在线程池中分页导出token消耗记录，返回导出的行数
+        if isinstance(model,dict):
+            model = model["model_name"]
+        exported = await run_in_thread_pool(functools.partial(
+            export_usage, file_path, export_format, channel_id, model,
+            start_time, end_time, since_last_export, checkpoint_name))
+        logger.info(f"exported {exported} usage rows to {file_path}")
+        return exported
     
 # 测试用main
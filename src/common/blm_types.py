@@ -1,12 +1,44 @@
+import asyncio
 import os
+import time
+from contextvars import ContextVar
 from typing import Any, Callable, Dict, List, Optional, Union
 
 curr_dir = os.path.dirname(__file__)
 
 dir_path = f"{curr_dir}/../../../../resource/blm_library/cache"
 dir_path = os.path.abspath(dir_path)
-if not os.path.exists(dir_path):
-    os.makedirs(dir_path)
+
+def ensure_cache_dir():
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    # deadline是time.monotonic()下的绝对时间，None表示不限
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+class BLMTimeoutError(asyncio.TimeoutError):
+    # 调用超过了timeout，请求已被取消
+    pass
+
+class BLMCallOutcome:
+    # 一次调用中适配器标记的本地拒绝原因，None表示请求确实发给了服务商
+    __slots__ = ('rejected',)
+
+    def __init__(self):
+        self.rejected: Optional[str] = None
+
+# 插件在调用适配器前设置，适配器在同一个调用链中通过mark_local_rejection标记
+current_call_outcome: ContextVar[Optional[BLMCallOutcome]] = ContextVar('blm_call_outcome', default=None)
+
+def mark_local_rejection(reason: str):
+    # 本地拒绝（prompt超限、模型不支持、凭据全部停用、请求参数错误、配额用尽改用其他模型等）
+    # 不代表服务商出了问题，不计入熔断器和路由的错误率
+    outcome = current_call_outcome.get()
+    if outcome is not None and outcome.rejected is None:
+        outcome.rejected = reason
 
 class BLMFunctionCall:
     functon_name:str
@@ -16,6 +48,8 @@ class BLMFunctionCall:
 class BLMAdapter:  
     def __init__(self):  
         self.cache_dir = dir_path  
+        # 正在进行的请求数，配置变化时旧适配器要等它归零后才关闭
+        self.inflight = 0
   
     async def completion_flow(  
         self,  
@@ -23,8 +57,11 @@ class BLMAdapter:
         model: Optional[Union[str, dict]] = None,
         context_id: Optional[str] = None,
         channel_id: Optional[str] = None,
+        deadline: Optional[float] = None,
     ) -> Optional[str]:  
-        ...  
+        # 适配器没有实现时视为不支持，请求没有发给服务商，不能算作模型的失败
+        mark_local_rejection("unsupported")
+        return None
   
     async def chat_flow(  
         self,  
@@ -33,7 +70,10 @@ class BLMAdapter:
         context_id: Optional[str] = None,  
         channel_id: Optional[str] = None,
         functions: Optional[List[BLMFunctionCall]] = None,  
+        deadline: Optional[float] = None,
+        ephemeral_prompt: Optional[List[str]] = None,
     ) -> Optional[str]:  
+        # ephemeral_prompt放在本次提交的前面一起发送，但不保存到会话中（比如助手的指令和检索资料）
         ...  
   
     async def assistant_flow(  
@@ -42,6 +82,7 @@ class BLMAdapter:
         prompt: Union[str, List[str]],  
         context_id: Optional[str] = None,
         channel_id: Optional[str] = None,
+        deadline: Optional[float] = None,
     ) -> Optional[str]:  
         ...  
   
@@ -56,8 +97,34 @@ class BLMAdapter:
     ) -> str:  
         ...  
   
+    async def embedding_flow(
+        self,
+        texts: Union[str, List[str]],
+        model: Optional[Union[str, dict]] = None,
+        channel_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[List[List[float]]]:
+        ...
+
     def model_list(self) -> List[dict]:  
         ...  
+
+    async def warm_up(self) -> dict:
+        return {}
+
+    def key_pool_status(self) -> List[dict]:
+        return []
+
+    def is_idle(self) -> bool:
+        # 没有正在进行的请求，包括在后台排队或运行的向量化批次
+        return self.inflight == 0
+
+    def inherit(self, old_adapter: 'BLMAdapter'):
+        # 配置变化重建适配器时，从旧适配器接过与配置无关的状态
+        ...
+
+    async def close(self):
+        ...
         
     def get_model(self,model_name:str) -> dict:  
         model_dict_list = self.model_list()
@@ -72,4 +139,7 @@ class BLMAdapter:
         ...
 
     def extract_json(self, string: str) -> List[Union[Dict[str, Any], List[Any]]]:
+        ...
+
+    def count_tokens(self, messages: Union[str, dict, List[Union[str, dict]]], model: Optional[Union[str, dict]] = None) -> int:
         ...
\ No newline at end of file
@@ -0,0 +1,83 @@
+import asyncio
+import math
+from typing import Dict, List, Optional
+
+from .message_store import MessageStore, StoredMessage, message_store
+from .token_counter import token_counter
+
+# 每个context_id一个会话对象，保存只追加的对话记录。
+# 同一个会话的请求通过锁按顺序执行，避免并发时一轮对话覆盖另一轮。
+# 会话中只保存消息存储中的引用，相同的消息（比如每个对话都一样的人设）只存一份。
+# 一轮对话（一次提交的所有消息加上回复）整体追加，裁剪历史时也只在轮次的边界处裁剪，
+# 不会把某一轮的前半段（比如人设）丢掉而只发送后半段。
+
+# 会话中最多保留的消息数量，超出时一次性丢弃较早的一半，均摊下来每次追加仍是O(1)
+MAX_SESSION_TURNS = 400
+
+
+class ChatSession:
+    def __init__(self, store: Optional[MessageStore] = None):
+        # store为None表示临时会话，不保存任何消息
+        self.store = store
+        self.turns: List[StoredMessage] = []
+        # 与turns一一对应，标记该消息是不是一轮对话的第一条
+        self.turn_starts: List[bool] = []
+        self.lock = asyncio.Lock()
+
+    def append_turn(self, messages: List[dict]):
+        if self.store is None or not messages:
+            return
+        for i, message in enumerate(messages):
+            self.turns.append(self.store.add(message["role"], message["content"]))
+            self.turn_starts.append(i == 0)
+        if len(self.turns) > MAX_SESSION_TURNS:
+            self.__drop(MAX_SESSION_TURNS // 2)
+
+    def __drop(self, count: int):
+        # 只丢弃完整的轮次
+        while count < len(self.turns) and not self.turn_starts[count]:
+            count += 1
+        for record in self.turns[:count]:
+            self.store.release(record)
+        del self.turns[:count]
+        del self.turn_starts[:count]
+
+    def window(self, new_messages: List[dict], max_tokens: int, model: Optional[str] = None) -> Optional[List[dict]]:
+        # 从最新的消息往前累计token，只复制需要发送的那一段历史。
+        # 历史消息的token估算值在入库时已经算好，这里只需乘上校准系数。
+        # 本次提交必须完整发送，放不下时返回None，而不是悄悄丢掉前面的人设或指令
+        budget = max_tokens - token_counter.count_tokens([], model)
+        for message in new_messages:
+            budget -= token_counter.count_message_tokens(message, model)
+        if budget < 0:
+            return None
+
+        factor = token_counter.get_factor(model)
+        start = len(self.turns)
+        while start > 0:
+            budget -= math.ceil(self.turns[start - 1].raw_tokens * factor)
+            if budget < 0:
+                break
+            start -= 1
+
+        # 放不下完整的一轮时，整轮丢弃
+        while start < len(self.turns) and not self.turn_starts[start]:
+            start += 1
+
+        return [record.message for record in self.turns[start:]] + new_messages
+
+
+class SessionStore:
+    def __init__(self, store: MessageStore = message_store):
+        self.store = store
+        self.sessions: Dict[str, ChatSession] = {}
+
+    def get(self, context_id: Optional[str]) -> ChatSession:
+        # 没有context_id时返回一个临时会话，不保存
+        if context_id is None:
+            return ChatSession()
+        session = self.sessions.get(context_id)
+        if session is None:
+            session = ChatSession(self.store)
+            self.sessions[context_id] = session
+        return session
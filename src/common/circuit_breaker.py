@@ -0,0 +1,120 @@
+import time
+from collections import deque
+from typing import Callable, Optional
+
+# 每个模型一个熔断器。连续失败或近期错误率过高时熔断，熔断期间的调用不经过网络直接失败；
+# 冷却时间过后进入半开状态，只放行一个探测请求，探测成功则恢复，失败则继续熔断。
+# allow()返回一个凭证（当时的代数），结果按凭证记录：状态变化或放行探测请求时代数加一，
+# 早先放行、在状态变化之后才结束的请求不再影响当前状态，半开状态下只有探测请求本身的结果有效。
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int = 5,
+                 error_rate_threshold: float = 0.5,
+                 window: int = 20,
+                 min_requests: int = 10,
+                 cooldown: float = 30,
+                 on_state_change: Optional[Callable[[str, str, str], None]] = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self.on_state_change = on_state_change
+
+        self.state = CLOSED
+        self.results = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.generation = 0
+
+    def __set_state(self, state: str):
+        if state == self.state:
+            return
+        old_state = self.state
+        self.state = state
+        self.generation += 1
+        if self.on_state_change is not None:
+            self.on_state_change(self.name, old_state, state)
+
+    def is_available(self) -> bool:
+        # 只查看，不占用探测名额
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= self.cooldown
+        return not self.probe_in_flight
+
+    def allow(self) -> Optional[int]:
+        # 放行时返回凭证，调用结束后传给record或release；不放行时返回None
+        if self.state == CLOSED:
+            return self.generation
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                return None
+            self.__set_state(HALF_OPEN)
+        if self.probe_in_flight:
+            return None
+        self.probe_in_flight = True
+        self.generation += 1
+        return self.generation
+
+    def release(self, ticket: int):
+        # 放行的请求没有真正发给服务商（本地拒绝），归还半开状态下的探测名额
+        if self.state == HALF_OPEN and ticket == self.generation:
+            self.probe_in_flight = False
+
+    def record(self, ticket: int, success: bool):
+        # 凭证过期的结果来自状态变化之前放行的请求，不能代表模型现在的状态
+        if ticket != self.generation:
+            return
+
+        self.results.append(success)
+
+        if self.state == HALF_OPEN:
+            self.probe_in_flight = False
+            if success:
+                self.results.clear()
+                self.consecutive_failures = 0
+                self.__set_state(CLOSED)
+            else:
+                self.__trip()
+            return
+
+        if success:
+            self.consecutive_failures = 0
+            return
+
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.__trip()
+            return
+
+        if len(self.results) >= self.min_requests:
+            error_rate = self.results.count(False) / len(self.results)
+            if error_rate >= self.error_rate_threshold:
+                self.__trip()
+
+    def __trip(self):
+        self.opened_at = time.monotonic()
+        self.__set_state(OPEN)
+
+    def status(self) -> dict:
+        error_rate = self.results.count(False) / len(self.results) if self.results else 0.0
+        state = self.state
+        if state == OPEN and self.is_available():
+            state = HALF_OPEN
+        return {
+            "state": state,
+            "available": self.is_available(),
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate": round(error_rate, 3),
+            "retry_after": max(self.cooldown - (time.monotonic() - self.opened_at), 0) if self.state == OPEN else 0,
+        }
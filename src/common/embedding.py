@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from array import array
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.util.threadPool import run_in_thread_pool
+
+from .blm_types import time_left
+from .token_counter import estimate_text_tokens
+
+# 向量化的公共部分：磁盘缓存和微批处理。
+# 各个适配器只需要提供一个“把一批文本变成向量”的函数即可。
+
+# 第二个参数是每条文本所属的频道，与文本一一对应
+EmbedBatchFunction = Callable[[List[str], List[Optional[str]]], Awaitable[Optional[List[List[float]]]]]
+
+# 单条查询语句中最多的参数个数，低于sqlite的默认上限
+CACHE_QUERY_SIZE = 500
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def split_usage(texts: List[str], channel_ids: List[Optional[str]], tokens: int) -> Dict[Optional[str], int]:
+    # 一个批次可能合并了多个频道的文本，按各频道文本的估算token占比分摊服务商返回的用量，
+    # 余数计入占比最大的频道，分摊结果之和与tokens相等
+    weights: Dict[Optional[str], int] = {}
+    for text, channel_id in zip(texts, channel_ids):
+        weights[channel_id] = weights.get(channel_id, 0) + max(estimate_text_tokens(text), 1)
+    total_weight = sum(weights.values())
+    shares = {channel_id: tokens * weight // total_weight for channel_id, weight in weights.items()}
+    largest = max(weights, key=lambda channel_id: weights[channel_id])
+    shares[largest] += tokens - sum(shares.values())
+    return shares
+
+
+class EmbeddingCache:
+    # 以内容哈希为键的向量缓存，每个模型一个sqlite文件，向量以float32存放。
+    # 按键查询，不需要把整个缓存读进内存，缓存再大也不影响加载时间。
+    # 这里的方法都是阻塞的，需要在线程池中调用。
+    def __init__(self, cache_dir: str, model: str):
+        safe_model = re.sub(r'[^\w.-]', '_', model)
+        self.file_path = f'{cache_dir}/embeddings/{safe_model}.sqlite3'
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+            connection = sqlite3.connect(self.file_path, check_same_thread=False)
+            connection.execute('CREATE TABLE IF NOT EXISTS embeddings (hash TEXT PRIMARY KEY, vector BLOB NOT NULL)')
+            self.connection = connection
+        return self.connection
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [content_hash(text) for text in texts]
+        unique_keys = list(set(keys))
+        found: Dict[str, bytes] = {}
+        with self.lock:
+            connection = self.__connect()
+            for i in range(0, len(unique_keys), CACHE_QUERY_SIZE):
+                part = unique_keys[i:i + CACHE_QUERY_SIZE]
+                placeholders = ','.join('?' * len(part))
+                for key, blob in connection.execute(f'SELECT hash, vector FROM embeddings WHERE hash IN ({placeholders})', part):
+                    found[key] = blob
+        return [array('f', found[key]).tolist() if key in found else None for key in keys]
+
+    def put_many(self, items: List[Tuple[str, List[float]]]):
+        rows = [(content_hash(text), array('f', vector).tobytes()) for text, vector in items]
+        with self.lock:
+            connection = self.__connect()
+            with connection:
+                connection.executemany('INSERT OR IGNORE INTO embeddings (hash, vector) VALUES (?, ?)', rows)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+
+class EmbeddingBatcher:
+    # 把并发调用方的文本合并成尽量满的批次再请求服务商，
+    # 相同的文本无论来自哪个调用方都只请求一次，已缓存的文本不再请求。
+    def __init__(self,
+                 cache: EmbeddingCache,
+                 embed_batch: EmbedBatchFunction,
+                 max_batch: int,
+                 max_wait: float = 0.02,
+                 request_timeout: Optional[float] = None):
+        self.cache = cache
+        self.embed_batch = embed_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.request_timeout = request_timeout
+
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.queue: List[Tuple[str, Optional[str]]] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        # 已经发出、还没有写完缓存的批次数
+        self.running = 0
+
+    def is_idle(self) -> bool:
+        # 没有排队的文本，也没有正在进行的批次
+        return not self.queue and self.running == 0
+
+    async def embed(self, texts: List[str], channel_id: Optional[str] = None,
+                    deadline: Optional[float] = None) -> Optional[List[List[float]]]:
+        try:
+            results: List[Optional[List[float]]] = await run_in_thread_pool(self.cache.get_many, texts)
+        except sqlite3.Error:
+            # 缓存读不出来时全部重新请求
+            results = [None] * len(texts)
+
+        futures: Dict[str, asyncio.Future] = {}
+        for text, vector in zip(texts, results):
+            if vector is None and text not in futures:
+                futures[text] = self.__enqueue(text, channel_id)
+
+        if futures:
+            # shield保证一个调用方超时不会取消其他调用方共享的请求
+            await asyncio.wait_for(asyncio.gather(*[asyncio.shield(future) for future in futures.values()]),
+                                   time_left(deadline))
+            for i, text in enumerate(texts):
+                if results[i] is None:
+                    results[i] = futures[text].result()
+
+        if any(vector is None for vector in results):
+            return None
+        return results
+
+    def __enqueue(self, text: str, channel_id: Optional[str]) -> asyncio.Future:
+        future = self.pending.get(text)
+        if future is not None:
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending[text] = future
+        self.queue.append((text, channel_id))
+
+        if len(self.queue) >= self.max_batch:
+            self.__flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self.__flush)
+        return future
+
+    def __flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.queue:
+            batch = self.queue[:self.max_batch]
+            self.queue = self.queue[self.max_batch:]
+            self.running += 1
+            asyncio.ensure_future(self.__run_batch(batch))
+
+    async def __run_batch(self, batch: List[Tuple[str, Optional[str]]]):
+        try:
+            await self.__send_batch(batch)
+        finally:
+            self.running -= 1
+
+    async def __send_batch(self, batch: List[Tuple[str, Optional[str]]]):
+        texts = [text for text, _ in batch]
+        channel_ids = [channel_id for _, channel_id in batch]
+
+        vectors = None
+        try:
+            vectors = await asyncio.wait_for(self.embed_batch(texts, channel_ids), self.request_timeout)
+        except Exception:
+            vectors = None
+
+        succeeded = vectors is not None and len(vectors) == len(texts)
+        if not succeeded:
+            vectors = [None] * len(texts)
+
+        for text, vector in zip(texts, vectors):
+            future = self.pending.pop(text, None)
+            if future is not None and not future.done():
+                future.set_result(vector)
+
+        # 先把结果交给调用方，再在线程池中写缓存
+        if succeeded:
+            try:
+                await run_in_thread_pool(self.cache.put_many, list(zip(texts, vectors)))
+            except (OSError, sqlite3.Error):
+                # 缓存写不进去不影响本次结果
+                pass
@@ -0,0 +1,96 @@
+import time
+from typing import Dict, List, Optional
+
+# 同一个服务商的多组凭据组成一个池，请求分散到当前未完成请求最少的凭据上。
+# 返回限流或鉴权错误的凭据会被暂时停用一段时间。
+
+# 限流错误的停用时间（秒）
+RATE_LIMIT_PARK_TIME = 60
+# 鉴权错误的停用时间（秒），这类错误通常需要人工处理，所以时间更长
+AUTH_ERROR_PARK_TIME = 600
+
+
+def mask_key(key: str) -> str:
+    # 日志和状态中只展示凭据的首尾几位
+    if not key:
+        return "-"
+    if len(key) <= 8:
+        return key[:2] + "***"
+    return key[:4] + "***" + key[-4:]
+
+
+class PooledKey:
+    __slots__ = ('name', 'credential', 'outstanding', 'parked_until', 'park_reason',
+                 'requests', 'prompt_tokens', 'completion_tokens', 'total_tokens')
+
+    def __init__(self, name: str, credential: dict):
+        self.name = name
+        self.credential = credential
+        self.outstanding = 0
+        self.parked_until = 0.0
+        self.park_reason = None
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+
+
+class KeyPool:
+    def __init__(self, credentials: List[dict], key_field: str):
+        self.keys: List[PooledKey] = []
+        self.update(credentials, key_field)
+
+    def update(self, credentials: List[dict], key_field: str):
+        # 凭据变化时重建池，仍然存在的凭据保留其统计和停用状态
+        existing: Dict[str, PooledKey] = {key.name: key for key in self.keys}
+        keys = []
+        for credential in credentials:
+            name = mask_key(credential.get(key_field))
+            key = existing.get(name)
+            if key is None or key.credential != credential:
+                key = PooledKey(name, credential)
+            keys.append(key)
+        self.keys = keys
+
+    def acquire(self) -> Optional[PooledKey]:
+        now = time.monotonic()
+        best = None
+        for key in self.keys:
+            if key.parked_until > now:
+                continue
+            if best is None or key.outstanding < best.outstanding:
+                best = key
+        if best is not None:
+            best.outstanding += 1
+            best.requests += 1
+        return best
+
+    def has_available(self) -> bool:
+        now = time.monotonic()
+        return any(key.parked_until <= now for key in self.keys)
+
+    def release(self, key: PooledKey):
+        key.outstanding = max(key.outstanding - 1, 0)
+
+    def park(self, key: PooledKey, reason: str):
+        park_time = AUTH_ERROR_PARK_TIME if reason == "auth" else RATE_LIMIT_PARK_TIME
+        key.parked_until = time.monotonic() + park_time
+        key.park_reason = reason
+
+    def record_usage(self, key: PooledKey, prompt_tokens: int, completion_tokens: int, total_tokens: int):
+        key.prompt_tokens += prompt_tokens
+        key.completion_tokens += completion_tokens
+        key.total_tokens += total_tokens
+
+    def status(self) -> List[dict]:
+        now = time.monotonic()
+        return [{
+            "key": key.name,
+            "outstanding": key.outstanding,
+            "parked": key.parked_until > now,
+            "park_reason": key.park_reason if key.parked_until > now else None,
+            "requests": key.requests,
+            "prompt_tokens": key.prompt_tokens,
+            "completion_tokens": key.completion_tokens,
+            "total_tokens": key.total_tokens,
+        } for key in self.keys]
@@ -0,0 +1,66 @@
+import hashlib
+import sys
+from typing import Dict
+
+from .token_counter import estimate_text_tokens, MESSAGE_OVERHEAD
+
+# 按内容寻址、带引用计数的消息存储。
+# 很多插件的每个对话都以同一段很长的人设或系统提示开头，会话中只保存指向这里的引用，
+# 相同role和内容的消息无论出现在多少个会话里都只存一份。
+# 每条消息的token估算值和发送用的dict在入库时算好，之后直接复用。
+
+
+class StoredMessage:
+    __slots__ = ('digest', 'role', 'content', 'raw_tokens', 'message', 'refcount')
+
+    def __init__(self, digest: bytes, role: str, content: str):
+        self.digest = digest
+        # role只有少数几种取值，驻留后所有记录共用同一个字符串
+        self.role = sys.intern(role)
+        self.content = content
+        # 未经校准的估算值，包含每条消息的固定开销
+        self.raw_tokens = estimate_text_tokens(content) + MESSAGE_OVERHEAD
+        # 发送给服务商的消息体，调用方不应修改它
+        self.message = {"role": self.role, "content": content}
+        self.refcount = 0
+
+
+def message_digest(role: str, content: str) -> bytes:
+    return hashlib.blake2b(f'{role}\0{content}'.encode('utf-8'), digest_size=16).digest()
+
+
+class MessageStore:
+    def __init__(self):
+        self.records: Dict[bytes, StoredMessage] = {}
+
+    def add(self, role: str, content: str) -> StoredMessage:
+        digest = message_digest(role, content)
+        record = self.records.get(digest)
+        if record is None:
+            record = StoredMessage(digest, role, content)
+            self.records[digest] = record
+        record.refcount += 1
+        return record
+
+    def release(self, record: StoredMessage):
+        record.refcount -= 1
+        if record.refcount <= 0:
+            self.records.pop(record.digest, None)
+
+    def status(self) -> dict:
+        references = 0
+        stored_chars = 0
+        referenced_chars = 0
+        for record in self.records.values():
+            references += record.refcount
+            stored_chars += len(record.content)
+            referenced_chars += len(record.content) * record.refcount
+        return {
+            "messages": len(self.records),
+            "references": references,
+            "stored_chars": stored_chars,
+            "referenced_chars": referenced_chars,
+        }
+
+
+message_store = MessageStore()
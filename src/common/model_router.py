@@ -0,0 +1,126 @@
+import time
+from typing import Callable, Dict, List, Optional
+
+# 在没有指定模型的调用中，根据实时数据在已启用的模型中挑选一个。
+# 考虑的因素有：剩余配额、滚动平均延迟（EWMA）、近期错误率、预估的prompt大小以及模型的费用类型。
+
+# 还没有样本的模型，假定一个比较乐观的延迟，让它有机会被选中从而获得样本
+DEFAULT_LATENCY = 2.0
+
+# 错误率高于该值的模型视为不健康，只有在没有健康模型时才会被选择
+UNHEALTHY_ERROR_RATE = 0.5
+# 不健康的模型在最后一次失败后经过这么多秒，会重新参与选择
+UNHEALTHY_RECOVERY_TIME = 60
+
+# 高费用模型的延迟惩罚倍数
+COST_PENALTY = {
+    "low-cost": 1.0,
+    "high-cost": 2.0,
+}
+
+# 候选模型列表及其剩余配额的缓存时间，避免每次调用都去读取配置
+CANDIDATE_TTL = 10
+
+# 剩余配额超过该值的模型视为不限配额，选中时不扣减缓存的配额
+UNLIMITED_QUOTA = 100000
+
+
+class ModelStats:
+    __slots__ = ('latency', 'error_rate', 'samples', 'last_failure')
+
+    def __init__(self):
+        self.latency = DEFAULT_LATENCY
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_failure = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        if self.error_rate < UNHEALTHY_ERROR_RATE:
+            return True
+        return now - self.last_failure > UNHEALTHY_RECOVERY_TIME
+
+
+class ModelRouter:
+    def __init__(self, latency_alpha: float = 0.3, error_alpha: float = 0.2):
+        self.latency_alpha = latency_alpha
+        self.error_alpha = error_alpha
+        self.stats: Dict[str, ModelStats] = {}
+        # [模型信息, 剩余配额]，配额在刷新候选列表时读取一次，之后每选中一次就在本地扣减
+        self.candidates: List[list] = []
+        self.candidates_time = 0.0
+
+    def get_stats(self, model_name: str) -> ModelStats:
+        stats = self.stats.get(model_name)
+        if stats is None:
+            stats = ModelStats()
+            self.stats[model_name] = stats
+        return stats
+
+    def record(self, model_name: str, latency: float, success: bool):
+        stats = self.get_stats(model_name)
+        if success:
+            if stats.samples == 0:
+                stats.latency = latency
+            else:
+                stats.latency += (latency - stats.latency) * self.latency_alpha
+            stats.samples += 1
+        else:
+            stats.last_failure = time.monotonic()
+        stats.error_rate += ((0.0 if success else 1.0) - stats.error_rate) * self.error_alpha
+
+    def invalidate(self):
+        self.candidates_time = 0.0
+
+    def get_candidates(self, model_list: Callable[[], List[dict]], quota_left: Callable[[str], int]) -> List[list]:
+        now = time.monotonic()
+        if now - self.candidates_time > CANDIDATE_TTL:
+            self.candidates = [[model_info, quota_left(model_info["model_name"])] for model_info in model_list()]
+            self.candidates_time = now
+        return self.candidates
+
+    def score(self, model_info: dict) -> float:
+        stats = self.stats.get(model_info["model_name"])
+        if stats is None:
+            latency, error_rate = DEFAULT_LATENCY, 0.0
+        else:
+            latency, error_rate = stats.latency, stats.error_rate
+        return latency * COST_PENALTY.get(model_info["type"], 1.0) * (1 + 4 * error_rate)
+
+    def pick(self,
+             model_list: Callable[[], List[dict]],
+             feature: str,
+             prompt_tokens: int,
+             quota_left: Callable[[str], int],
+             is_available: Callable[[str], bool]) -> Optional[dict]:
+        # quota_left只在刷新候选列表时调用；is_available每次都会调用，必须足够轻量
+        best = None
+        best_score = None
+        fallback = None
+        fallback_score = None
+        now = time.monotonic()
+
+        for candidate in self.get_candidates(model_list, quota_left):
+            model_info, quota = candidate
+            if feature not in model_info["supported_feature"]:
+                continue
+            if prompt_tokens > model_info["max-token"]:
+                continue
+            if quota <= 0 or not is_available(model_info["model_name"]):
+                continue
+
+            score = self.score(model_info)
+            stats = self.stats.get(model_info["model_name"])
+            if stats is not None and not stats.is_healthy(now):
+                if fallback_score is None or score < fallback_score:
+                    fallback, fallback_score = candidate, score
+                continue
+
+            if best_score is None or score < best_score:
+                best, best_score = candidate, score
+
+        picked = best if best is not None else fallback
+        if picked is None:
+            return None
+        if picked[1] < UNLIMITED_QUOTA:
+            picked[1] -= 1
+        return picked[0]
@@ -0,0 +1,158 @@
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from peewee import fn
+
+from .database import AmiyaBotBLMLibraryTokenConsumeModel
+
+# 按频道和模型限制每日token用量。
+# 逐次汇总数据库太慢，所以在内存中维护当天每个频道、每个模型的累计用量：
+# 启动时从数据库汇总一次，之后每次请求按服务商返回的usage累加，
+# 并定期与数据库重新对账，保证重启或多进程写入后依然准确。
+
+# 与数据库对账的间隔（秒）
+RECONCILE_INTERVAL = 300
+
+# 没有channel_id的调用在数据库中记为"-"
+NO_CHANNEL = "-"
+
+
+def _today_start() -> datetime:
+    return datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _channel_key(channel_id: Optional[str]) -> str:
+    return channel_id if channel_id else NO_CHANNEL
+
+
+class TokenBudget:
+    def __init__(self):
+        # channel_id -> model_name -> 当天累计的total_tokens，以及每个频道所有模型的合计，
+        # 检查预算时只需要常数次字典查找
+        self.totals: Dict[str, Dict[str, int]] = {}
+        self.channel_totals: Dict[str, int] = {}
+        self.day = _today_start()
+        self.budgets: List[dict] = []
+        self.last_reconcile_time = 0.0
+        # 对账查询进行期间累加的用量（行号, channel_id, model_name, tokens），查询结束后
+        # 只补回行号大于查询所见最大行号的部分，已经包含在查询结果中的不会重复计算
+        self.pending: Optional[List[Tuple[int, str, str, int]]] = None
+
+    def set_budgets(self, budgets: Optional[List[dict]]):
+        self.budgets = [budget for budget in (budgets or []) if budget.get("daily_tokens")]
+
+    def __roll_day(self):
+        today = _today_start()
+        if today != self.day:
+            self.day = today
+            self.totals = {}
+            self.channel_totals = {}
+
+    def __add(self, channel_id: str, model_name: str, tokens: int):
+        models = self.totals.setdefault(channel_id, {})
+        models[model_name] = models.get(model_name, 0) + tokens
+        self.channel_totals[channel_id] = self.channel_totals.get(channel_id, 0) + tokens
+
+    def load_totals(self) -> Tuple[int, List[Tuple[str, str, int]]]:
+        # 按频道和模型汇总当天的用量，汇总在数据库中完成，每组只返回一行。
+        # 先取当前最大行号，只汇总不超过它的行，用于对账时去重
+        model = AmiyaBotBLMLibraryTokenConsumeModel
+        max_id = model.select(fn.MAX(model.id)).scalar() or 0
+        query = (model
+                 .select(model.channel_id, model.model_name, fn.SUM(model.total_tokens).alias('tokens'))
+                 .where((model.exec_time >= _today_start()) & (model.id <= max_id))
+                 .group_by(model.channel_id, model.model_name)
+                 .tuples())
+        return max_id, [(_channel_key(channel_id), model_name, int(tokens or 0)) for channel_id, model_name, tokens in query]
+
+    def __replace_totals(self, rows: List[Tuple[str, str, int]]):
+        self.totals = {}
+        self.channel_totals = {}
+        for channel_id, model_name, tokens in rows:
+            self.__add(channel_id, model_name, tokens)
+
+    def seed(self):
+        self.day = _today_start()
+        _, rows = self.load_totals()
+        self.__replace_totals(rows)
+        self.last_reconcile_time = time.monotonic()
+
+    def need_reconcile(self) -> bool:
+        return self.pending is None and time.monotonic() - self.last_reconcile_time >= RECONCILE_INTERVAL
+
+    def begin_reconcile(self):
+        self.pending = []
+        self.last_reconcile_time = time.monotonic()
+
+    def finish_reconcile(self, loaded: Optional[Tuple[int, List[Tuple[str, str, int]]]]):
+        # loaded为None表示查询失败，保留内存中的数据
+        pending = self.pending
+        self.pending = None
+        if loaded is None:
+            return
+        self.__roll_day()
+        max_id, rows = loaded
+        self.__replace_totals(rows)
+        for row_id, channel_id, model_name, tokens in pending:
+            if row_id > max_id:
+                self.__add(channel_id, model_name, tokens)
+
+    def record(self, channel_id: Optional[str], model_name: str, total_tokens: int, row_id: int):
+        # 在用量写入数据库之后调用，row_id是写入的行号
+        self.__roll_day()
+        channel_id = _channel_key(channel_id)
+        self.__add(channel_id, model_name, total_tokens)
+        if self.pending is not None:
+            self.pending.append((row_id, channel_id, model_name, total_tokens))
+
+    def used(self, channel_id: Optional[str], model_name: Optional[str] = None) -> int:
+        self.__roll_day()
+        channel_id = _channel_key(channel_id)
+        if model_name is None:
+            return self.channel_totals.get(channel_id, 0)
+        return self.totals.get(channel_id, {}).get(model_name, 0)
+
+    def __match(self, budget: dict, channel_id: str, model_name: str) -> bool:
+        budget_channel = budget.get("channel_id") or "*"
+        if budget_channel != "*" and budget_channel != channel_id:
+            return False
+        budget_model = budget.get("model")
+        return not budget_model or budget_model == model_name
+
+    def check(self, channel_id: Optional[str], model_name: str, prompt_tokens: int) -> Tuple[Optional[str], Optional[dict]]:
+        # 返回可以使用的模型；超出预算且没有可降级的模型时返回None，同时返回触发限制的那条预算
+        # 已经触发过降级的预算不再限制降级后的模型，否则不区分模型的预算会让降级毫无意义
+        channel_id = _channel_key(channel_id)
+        tried = set()
+        triggered = []
+        exceeded = None
+        while model_name not in tried:
+            tried.add(model_name)
+            exceeded = None
+            for budget in self.budgets:
+                if any(budget is item for item in triggered) or not self.__match(budget, channel_id, model_name):
+                    continue
+                used = self.used(channel_id, budget.get("model") or None)
+                if used + prompt_tokens > budget["daily_tokens"]:
+                    exceeded = budget
+                    break
+            if exceeded is None:
+                return model_name, None
+            downgrade_model = exceeded.get("downgrade_model")
+            if not downgrade_model:
+                return None, exceeded
+            triggered.append(exceeded)
+            model_name = downgrade_model
+        return None, exceeded
+
+    def status(self) -> List[dict]:
+        self.__roll_day()
+        return [{
+            "channel_id": channel_id,
+            "model": model_name,
+            "total_tokens": tokens,
+        } for channel_id, models in sorted(self.totals.items()) for model_name, tokens in sorted(models.items())]
+
+
+token_budget = TokenBudget()
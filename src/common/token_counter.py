@@ -0,0 +1,161 @@
+import json
+import math
+import re
+import time
+from functools import lru_cache
+from typing import Dict, List, Optional, Union
+
+from .database import AmiyaBotBLMLibraryMetaStorageModel
+
+# 离线的Token估算器，不需要下载任何词表。
+# 按字符类别估算：中日韩文字大约一字一token，英文单词大约四个字母一个token，
+# 数字大约三位一个token，标点和其他符号各算一个token。
+# 估算结果再乘以每个模型的校准系数，校准系数由服务商返回的真实usage不断修正。
+
+_token_pattern = re.compile(
+    r'(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff])'
+    r'|(?P<word>[A-Za-z]+)'
+    r'|(?P<digit>[0-9]+)'
+    r'|(?P<space>\s+)'
+    r'|(?P<other>.)',
+    re.S
+)
+
+# 每条消息的固定开销（role、分隔符等），参考OpenAI的计算方式
+MESSAGE_OVERHEAD = 4
+# 回复的引导开销
+REPLY_OVERHEAD = 3
+
+CALIBRATION_META_KEY = "token_counter_calibration"
+
+# 校准系数的平滑因子和上下限，防止个别异常数据把系数带偏
+CALIBRATION_ALPHA = 0.2
+CALIBRATION_MIN = 0.3
+CALIBRATION_MAX = 3.0
+
+# 最多缓存的消息数量
+MESSAGE_CACHE_SIZE = 8192
+
+
+@lru_cache(maxsize=MESSAGE_CACHE_SIZE)
+def estimate_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+
+    tokens = 0
+    for match in _token_pattern.finditer(text):
+        kind = match.lastgroup
+        if kind == 'cjk':
+            tokens += 1
+        elif kind == 'word':
+            tokens += math.ceil(len(match.group()) / 4)
+        elif kind == 'digit':
+            tokens += math.ceil(len(match.group()) / 3)
+        elif kind == 'other':
+            tokens += 1
+    return tokens
+
+
+def _message_content(message: Union[str, dict]) -> str:
+    if isinstance(message, dict):
+        return message.get("content") or ""
+    return message or ""
+
+
+class TokenCounter:
+    def __init__(self):
+        self.calibration: Dict[str, float] = {}
+        self.calibration_loaded = False
+        self.calibration_dirty = False
+        self.last_save_time = 0.0
+        self.save_interval = 300
+
+    def load_calibration(self):
+        self.calibration_loaded = True
+        try:
+            meta = AmiyaBotBLMLibraryMetaStorageModel.get_or_none(
+                AmiyaBotBLMLibraryMetaStorageModel.key == CALIBRATION_META_KEY)
+            if meta is not None:
+                self.calibration.update(json.loads(meta.meta_str))
+        except Exception:
+            self.calibration = {}
+
+    def save_calibration(self):
+        meta_str = json.dumps(self.calibration)
+        meta = AmiyaBotBLMLibraryMetaStorageModel.get_or_none(
+            AmiyaBotBLMLibraryMetaStorageModel.key == CALIBRATION_META_KEY)
+        if meta:
+            meta.meta_str = meta_str
+            meta.save()
+        else:
+            AmiyaBotBLMLibraryMetaStorageModel(key=CALIBRATION_META_KEY, meta_str=meta_str).save()
+        self.calibration_dirty = False
+        self.last_save_time = time.time()
+
+    def flush_calibration(self):
+        # 距上次保存不足save_interval的修正只在内存中，卸载插件时补存
+        if not self.calibration_dirty:
+            return
+        try:
+            self.save_calibration()
+        except Exception:
+            pass
+
+    def get_factor(self, model: Optional[str]) -> float:
+        if not self.calibration_loaded:
+            self.load_calibration()
+        if model is None:
+            return 1.0
+        return self.calibration.get(model, 1.0)
+
+    def count_raw(self, messages: Union[str, dict, List[Union[str, dict]]]) -> int:
+        # 未经校准的估算值，校准时要用这个值和真实值比较
+        if isinstance(messages, (str, dict)):
+            messages = [messages]
+
+        tokens = REPLY_OVERHEAD
+        for message in messages:
+            tokens += estimate_text_tokens(_message_content(message)) + MESSAGE_OVERHEAD
+        return tokens
+
+    def count_message_tokens(self, message: Union[str, dict], model: Optional[str] = None) -> int:
+        return math.ceil((estimate_text_tokens(_message_content(message)) + MESSAGE_OVERHEAD) * self.get_factor(model))
+
+    def count_tokens(self, messages: Union[str, dict, List[Union[str, dict]]], model: Optional[str] = None) -> int:
+        return math.ceil(self.count_raw(messages) * self.get_factor(model))
+
+    def pick_messages(self, messages: list, max_tokens: int, model: Optional[str] = None) -> list:
+        # 从后向前累计token，返回不超过max_tokens的最长后缀
+        budget = max_tokens - math.ceil(REPLY_OVERHEAD * self.get_factor(model))
+        for i in range(len(messages) - 1, -1, -1):
+            budget -= self.count_message_tokens(messages[i], model)
+            if budget < 0:
+                return messages[i + 1:]
+        return messages
+
+    def calibrate(self, model: str, estimated: int, actual: int):
+        # 使用服务商返回的usage.prompt_tokens来修正估算系数
+        if not model or estimated <= 0 or actual <= 0:
+            return
+
+        ratio = min(max(actual / estimated, CALIBRATION_MIN), CALIBRATION_MAX)
+        factor = self.get_factor(model)
+        if model not in self.calibration:
+            factor = ratio
+        else:
+            factor = factor * (1 - CALIBRATION_ALPHA) + ratio * CALIBRATION_ALPHA
+        self.calibration[model] = round(factor, 4)
+        self.calibration_dirty = True
+
+        if time.time() - self.last_save_time > self.save_interval:
+            try:
+                self.save_calibration()
+            except Exception:
+                pass
+
+
+token_counter = TokenCounter()
+
+
+def count_tokens(messages: Union[str, dict, List[Union[str, dict]]], model: Optional[str] = None) -> int:
+    return token_counter.count_tokens(messages, model)
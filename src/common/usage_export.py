@@ -0,0 +1,109 @@
+import csv
+import hashlib
+import json
+import time
+from datetime import datetime
+from typing import Optional
+
+from .database import AmiyaBotBLMLibraryMetaStorageModel, AmiyaBotBLMLibraryTokenConsumeModel
+
+# 以流的方式导出token消耗记录。按主键分页（keyset pagination），每次只取一页，
+# 无论表有多大，内存占用都是固定的。
+# 增量导出后，在meta storage中记录导出到的最后一个id，下次只导出新增的部分。
+# 检查点按名称和筛选条件区分，带筛选条件的导出不会影响其他条件的检查点。
+
+EXPORT_FIELDS = ["id", "exec_id", "channel_id", "model_name", "prompt_tokens", "completion_tokens", "total_tokens", "exec_time"]
+
+EXPORT_BATCH_SIZE = 1000
+
+
+def _checkpoint_key(checkpoint_name: str, filters: Optional[dict] = None) -> str:
+    key = f"usage_export_checkpoint_{checkpoint_name}"
+    if filters:
+        filters_str = json.dumps(filters, sort_keys=True, ensure_ascii=False, default=str)
+        key += "_" + hashlib.sha1(filters_str.encode('utf-8')).hexdigest()[:12]
+    return key
+
+
+def load_export_checkpoint(checkpoint_name: str, filters: Optional[dict] = None) -> int:
+    meta = AmiyaBotBLMLibraryMetaStorageModel.get_or_none(
+        AmiyaBotBLMLibraryMetaStorageModel.key == _checkpoint_key(checkpoint_name, filters))
+    if meta is None:
+        return 0
+    try:
+        return int(json.loads(meta.meta_str)["last_id"])
+    except (ValueError, KeyError, TypeError):
+        return 0
+
+
+def save_export_checkpoint(checkpoint_name: str, last_id: int, filters: Optional[dict] = None):
+    checkpoint_key = _checkpoint_key(checkpoint_name, filters)
+    meta_str = json.dumps({"last_id": last_id, "export_time": time.time()})
+    meta = AmiyaBotBLMLibraryMetaStorageModel.get_or_none(
+        AmiyaBotBLMLibraryMetaStorageModel.key == checkpoint_key)
+    if meta:
+        meta.meta_str = meta_str
+        meta.save()
+    else:
+        AmiyaBotBLMLibraryMetaStorageModel(key=checkpoint_key, meta_str=meta_str).save()
+
+
+def export_usage(file_path: str,
+                 export_format: str = "csv",
+                 channel_id: Optional[str] = None,
+                 model_name: Optional[str] = None,
+                 start_time: Optional[datetime] = None,
+                 end_time: Optional[datetime] = None,
+                 since_last_export: bool = False,
+                 checkpoint_name: str = "default") -> int:
+    if export_format not in ("csv", "jsonl"):
+        raise ValueError(f"不支持的导出格式: {export_format}")
+
+    model = AmiyaBotBLMLibraryTokenConsumeModel
+
+    filters = {key: value for key, value in (("channel_id", channel_id), ("model_name", model_name),
+                                              ("start_time", start_time), ("end_time", end_time)) if value is not None}
+
+    conditions = []
+    if channel_id is not None:
+        conditions.append(model.channel_id == channel_id)
+    if model_name is not None:
+        conditions.append(model.model_name == model_name)
+    if start_time is not None:
+        conditions.append(model.exec_time >= start_time)
+    if end_time is not None:
+        conditions.append(model.exec_time < end_time)
+
+    last_id = load_export_checkpoint(checkpoint_name, filters) if since_last_export else 0
+    exported = 0
+
+    with open(file_path, 'w', encoding='utf-8', newline='') as file:
+        writer = None
+        if export_format == "csv":
+            writer = csv.writer(file)
+            writer.writerow(EXPORT_FIELDS)
+
+        while True:
+            query = model.select().where(model.id > last_id)
+            for condition in conditions:
+                query = query.where(condition)
+            rows = list(query.order_by(model.id).limit(EXPORT_BATCH_SIZE).dicts())
+
+            if not rows:
+                break
+
+            for row in rows:
+                values = [row[field] for field in EXPORT_FIELDS]
+                values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+                if writer is not None:
+                    writer.writerow(values)
+                else:
+                    file.write(json.dumps(dict(zip(EXPORT_FIELDS, values)), ensure_ascii=False) + '\n')
+
+            exported += len(rows)
+            last_id = rows[-1]["id"]
+
+    # 只有增量导出才更新检查点，并且要在写完整个文件之后，中途失败时下次会重新导出
+    if since_last_export:
+        save_export_checkpoint(checkpoint_name, last_id, filters)
+    return exported
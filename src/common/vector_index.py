@@ -0,0 +1,255 @@
+import functools
+import json
+import math
+import os
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.util.threadPool import run_in_thread_pool
+
+from .embedding import content_hash
+from .token_counter import estimate_text_tokens
+
+# 本地的向量检索。向量以float32连续存放在.npy文件中，加载时使用内存映射，
+# 几乎不占用加载时间和内存。文档变化时只对新增的文档重新向量化。
+# 依赖numpy，没有安装numpy时检索功能不可用。
+# 建立索引时的聚类和文件读写都在线程池中进行，不阻塞事件循环。
+
+EmbedFunction = Callable[[List[str]], Awaitable[Optional[List[List[float]]]]]
+
+# 单个分块的最大token数，需要小于所有向量模型的max-token
+CHUNK_MAX_TOKENS = 300
+
+# 向量数量超过该值时，建立粗聚类索引，只在最近的几个簇中搜索
+CLUSTER_THRESHOLD = 4096
+CLUSTER_PROBES = 8
+CLUSTER_ITERATIONS = 10
+
+
+def numpy_available() -> bool:
+    try:
+        import numpy
+        return True
+    except ImportError:
+        return False
+
+
+def chunk_document(document: str, max_tokens: int = CHUNK_MAX_TOKENS) -> List[str]:
+    # 先按段落切分，段落过长时再按句子切分，然后把相邻的小段合并到不超过max_tokens
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', document):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if estimate_text_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r'(?<=[。！？!?；;.\n])', paragraph):
+            sentence = sentence.strip()
+            while sentence:
+                # 连标点都没有的超长句子，只能硬切
+                cut = len(sentence)
+                while estimate_text_tokens(sentence[:cut]) > max_tokens:
+                    cut = cut // 2
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].strip()
+
+    chunks = []
+    current = ""
+    current_tokens = 0
+    for piece in pieces:
+        piece_tokens = estimate_text_tokens(piece)
+        if current and current_tokens + piece_tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current = f"{current}\n{piece}" if current else piece
+        current_tokens += piece_tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class VectorIndex:
+    def __init__(self, index_dir: str):
+        self.index_dir = index_dir
+        self.vectors_path = f'{index_dir}/vectors.npy'
+        self.centroids_path = f'{index_dir}/centroids.npy'
+        self.meta_path = f'{index_dir}/meta.json'
+
+        self.model: Optional[str] = None
+        self.chunks: List[str] = []
+        # 文档哈希 -> 该文档的分块在向量数组中的行号
+        self.documents: Dict[str, List[int]] = {}
+        self.clusters: List[List[int]] = []
+
+        self.vectors = None
+        self.centroids = None
+
+    def load(self) -> bool:
+        if not os.path.exists(self.meta_path) or not os.path.exists(self.vectors_path):
+            return False
+
+        import numpy as np
+
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+            self.model = meta["model"]
+            self.chunks = meta["chunks"]
+            self.documents = meta["documents"]
+            self.clusters = meta.get("clusters", [])
+            self.vectors = np.load(self.vectors_path, mmap_mode='r')
+            if self.clusters and os.path.exists(self.centroids_path):
+                self.centroids = np.load(self.centroids_path)
+            else:
+                self.clusters, self.centroids = [], None
+        except (OSError, ValueError, KeyError):
+            self.model, self.chunks, self.documents, self.clusters = None, [], {}, []
+            self.vectors, self.centroids = None, None
+            return False
+        return True
+
+    async def build(self, documents: List[str], model: str, embed: EmbedFunction) -> bool:
+        if self.vectors is None:
+            await run_in_thread_pool(self.load)
+
+        # 向量模型变化时，旧的向量无法复用
+        if self.model != model:
+            self.chunks, self.documents, self.vectors = [], {}, None
+
+        document_hashes = [content_hash(document) for document in documents]
+        if self.vectors is not None and sorted(set(document_hashes)) == sorted(self.documents.keys()):
+            return True
+
+        # 保留仍然存在的文档的向量，只对新增的文档分块并向量化
+        new_chunks: List[str] = []
+        new_documents: Dict[str, List[int]] = {}
+        kept_rows: List[int] = []
+        pending: List[Tuple[str, List[str]]] = []
+
+        for document_hash, document in zip(document_hashes, documents):
+            if document_hash in new_documents:
+                continue
+            if document_hash in self.documents and self.vectors is not None:
+                rows = self.documents[document_hash]
+                new_documents[document_hash] = list(range(len(kept_rows), len(kept_rows) + len(rows)))
+                kept_rows.extend(rows)
+                new_chunks.extend(self.chunks[row] for row in rows)
+            else:
+                new_documents[document_hash] = []
+                pending.append((document_hash, chunk_document(document)))
+
+        pending_texts = [chunk for _, chunks in pending for chunk in chunks]
+        pending_vectors = []
+        if pending_texts:
+            pending_vectors = await embed(pending_texts)
+            if pending_vectors is None:
+                return False
+
+        for document_hash, chunks in pending:
+            start = len(new_chunks)
+            new_documents[document_hash] = list(range(start, start + len(chunks)))
+            new_chunks.extend(chunks)
+
+        return await run_in_thread_pool(functools.partial(
+            self.__save, model, new_chunks, new_documents, kept_rows, pending_vectors))
+
+    def __save(self, model: str, new_chunks: List[str], new_documents: Dict[str, List[int]],
+               kept_rows: List[int], pending_vectors: List[List[float]]) -> bool:
+        import numpy as np
+
+        parts = []
+        if kept_rows:
+            parts.append(np.asarray(self.vectors[kept_rows], dtype=np.float32))
+        # 保留的行已经复制出来，释放对旧文件的内存映射，否则Windows上无法替换仍被映射的vectors.npy
+        self.vectors, self.centroids = None, None
+        if pending_vectors:
+            added = np.asarray(pending_vectors, dtype=np.float32)
+            norms = np.linalg.norm(added, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            parts.append(added / norms)
+
+        if parts:
+            vectors = np.ascontiguousarray(np.concatenate(parts, axis=0))
+        else:
+            vectors = np.zeros((0, 0), dtype=np.float32)
+
+        clusters, centroids = [], None
+        if len(vectors) >= CLUSTER_THRESHOLD:
+            clusters, centroids = self.__cluster(vectors)
+
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        # 先写临时文件再替换，避免中途失败留下损坏的索引
+        with open(f'{self.vectors_path}.tmp', 'wb') as file:
+            np.save(file, vectors)
+        os.replace(f'{self.vectors_path}.tmp', self.vectors_path)
+        if centroids is not None:
+            with open(f'{self.centroids_path}.tmp', 'wb') as file:
+                np.save(file, centroids)
+            os.replace(f'{self.centroids_path}.tmp', self.centroids_path)
+
+        with open(f'{self.meta_path}.tmp', 'w', encoding='utf-8') as file:
+            json.dump({"model": model, "chunks": new_chunks, "documents": new_documents, "clusters": clusters},
+                      file, ensure_ascii=False)
+        os.replace(f'{self.meta_path}.tmp', self.meta_path)
+
+        return self.load()
+
+    def __cluster(self, vectors):
+        # 简单的球面k-means，簇的数量取向量数量的平方根
+        import numpy as np
+
+        count = len(vectors)
+        k = int(math.sqrt(count))
+        rng = np.random.default_rng(0)
+        centroids = vectors[rng.choice(count, k, replace=False)].copy()
+
+        for _ in range(CLUSTER_ITERATIONS):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            for i in range(k):
+                members = vectors[assignment == i]
+                if len(members) == 0:
+                    continue
+                centroid = members.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                if norm > 0:
+                    centroids[i] = centroid / norm
+
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+        clusters = [np.nonzero(assignment == i)[0].tolist() for i in range(k)]
+        return clusters, centroids.astype(np.float32)
+
+    def search(self, query: List[float], top_k: int = 5) -> List[Tuple[str, float]]:
+        # 重建索引在线程池中进行，先取出当前的数据，避免搜索到一半时被替换
+        vectors, centroids, clusters, chunks = self.vectors, self.centroids, self.clusters, self.chunks
+        if vectors is None or len(vectors) == 0:
+            return []
+
+        import numpy as np
+
+        query = np.asarray(query, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm == 0:
+            return []
+        query = query / norm
+
+        if centroids is not None:
+            probes = np.argsort(-(centroids @ query))[:CLUSTER_PROBES]
+            rows = np.asarray(sorted(row for probe in probes for row in clusters[probe]), dtype=np.int64)
+            if len(rows) == 0:
+                return []
+            scores = vectors[rows] @ query
+        else:
+            rows = None
+            scores = vectors @ query
+
+        top_k = min(top_k, len(scores))
+        best = np.argpartition(-scores, top_k - 1)[:top_k]
+        best = best[np.argsort(-scores[best])]
+
+        results = []
+        for i in best:
+            row = int(rows[i]) if rows is not None else int(i)
+            results.append((chunks[row], float(scores[i])))
+        return results
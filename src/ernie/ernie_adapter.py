@@ -11,17 +11,39 @@ from core.util.threadPool import run_in_thread_pool
 from amiyabot.log import LoggerManager
 from amiyabot.network.httpRequests import http_requests
 
-from ..common.blm_types import BLMAdapter, BLMFunctionCall
+from ..common.blm_types import BLMAdapter, BLMFunctionCall, mark_local_rejection, time_left
 from ..common.database import AmiyaBotBLMLibraryMetaStorageModel, AmiyaBotBLMLibraryTokenConsumeModel
+from ..common.token_counter import token_counter
+from ..common.token_budget import token_budget
+from ..common.embedding import EmbeddingBatcher, EmbeddingCache, split_usage
+from ..common.key_pool import KeyPool, PooledKey
+from ..common.chat_session import ChatSession, SessionStore
 
 logger = LoggerManager('BLM-ERNIE')
 
+# 千帆的错误码：限流类（请求数、QPS、总量超限）
+RATE_LIMIT_ERROR_CODES = {4, 17, 18, 19, 336501, 336502}
+# 鉴权类（无权限、凭据无效等）
+AUTH_ERROR_CODES = {6, 13, 14, 15}
+# access token无效或过期，不停用应用，下次调用时重新获取即可
+ACCESS_TOKEN_ERROR_CODES = {110, 111}
+
+MODEL_URL_MAP = {
+    "ERNIE-Bot 4.0":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro",
+    "ERNIE-Bot":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions",
+    "ERNIE-Bot-turbo":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/eb-instant"
+}
+
 class ERNIEAdapter(BLMAdapter):
     def __init__(self, plugin):
         super().__init__()
         self.plugin:AmiyaBotPluginInstance = plugin
-        self.context_holder = {}
+        self.sessions = SessionStore()
         self.query_times = []
+        self.embedding_batchers = {}
+        self.key_pool = KeyPool([], "api_key")
+        self.key_pool_credentials = []
+        self.access_tokens = {}
     
     def debug_log(self, msg):
         show_log = self.plugin.get_config("show_log")
@@ -83,10 +105,65 @@ class ERNIEAdapter(BLMAdapter):
             ernie_4_cost = "low-cost"
         if disable_high_cost != True:
             model_list_response.append({"model_name":"ERNIE-Bot 4.0","type":ernie_4_cost, "max-token":4000,"supported_feature":["completion_flow","chat_flow"]})
+        model_list_response.append({"model_name":"Embedding-V1","type":"low-cost", "max-token":384,"supported_feature":["embedding_flow"]})
         return model_list_response
 
-    async def __get_access_token(self, channel_id):
-        appid = self.get_config("app_id")
+    def __get_key_pool(self) -> KeyPool:
+        # app_id/api_key/secret_key之外，还可以在credentials中配置更多的应用，请求会分散到这些应用上
+        credentials = []
+        primary = {"app_id": self.get_config("app_id"), "api_key": self.get_config("api_key"), "secret_key": self.get_config("secret_key")}
+        for credential in [primary] + (self.get_config("credentials") or []):
+            credential = {field: credential.get(field) for field in ("app_id", "api_key", "secret_key")}
+            if credential["app_id"] and credential["api_key"] and credential["secret_key"] and credential not in credentials:
+                credentials.append(credential)
+        if credentials != self.key_pool_credentials:
+            self.key_pool.update(credentials, "api_key")
+            self.key_pool_credentials = credentials
+        return self.key_pool
+
+    def __park_key_on_error(self, key_pool: KeyPool, key: PooledKey, error_code):
+        if error_code in RATE_LIMIT_ERROR_CODES:
+            key_pool.park(key, "rate_limit")
+            self.debug_log(f"key {key.name} parked: rate limit {error_code}")
+        elif error_code in AUTH_ERROR_CODES:
+            key_pool.park(key, "auth")
+            self.debug_log(f"key {key.name} parked: auth error {error_code}")
+        if error_code in ACCESS_TOKEN_ERROR_CODES:
+            # access token失效，下次重新获取
+            self.access_tokens.pop(key.credential["app_id"], None)
+            AmiyaBotBLMLibraryMetaStorageModel.delete().where(
+                AmiyaBotBLMLibraryMetaStorageModel.key == "ernie_access_token_" + key.credential["app_id"]).execute()
+
+    def key_pool_status(self) -> List[dict]:
+        return self.__get_key_pool().status()
+
+    def is_idle(self) -> bool:
+        return self.inflight == 0 and all(batcher.is_idle() for batcher in self.embedding_batchers.values())
+
+    def inherit(self, old_adapter):
+        # 会话、凭据的统计和停用状态与连接无关，直接沿用
+        self.sessions = old_adapter.sessions
+        self.query_times = old_adapter.query_times
+        self.key_pool = old_adapter.key_pool
+        self.access_tokens = old_adapter.access_tokens
+
+        # 向量化的批处理器连同排队中的文本和缓存一起接过来，之后的批次由新适配器发送
+        for model, batcher in old_adapter.embedding_batchers.items():
+            batcher.embed_batch = self.__embed_batch_function(model)
+        self.embedding_batchers = old_adapter.embedding_batchers
+        old_adapter.embedding_batchers = {}
+
+    async def close(self):
+        for batcher in self.embedding_batchers.values():
+            batcher.cache.close()
+
+    async def __get_access_token(self, key: PooledKey, deadline: Optional[float] = None):
+        appid = key.credential["app_id"]
+
+        # 每个应用各自持有一个access token，先查内存，再查数据库
+        access_token_json = self.access_tokens.get(appid)
+        if access_token_json is not None and access_token_json["expire_time"] > time.time():
+            return access_token_json["access_token"]
 
         access_token_key = "ernie_access_token_"+appid
 
@@ -104,52 +181,153 @@ class ERNIEAdapter(BLMAdapter):
         
         if "access_token" in access_token_json and "expire_time" in access_token_json:
             if access_token_json["expire_time"] > time.time():
+                self.access_tokens[appid] = access_token_json
                 return access_token_json["access_token"]
             else:
                 self.debug_log(f"access token expired!")
         
         self.debug_log(f"get new access token")
 
-        api_key = self.get_config("api_key")
-        secret_key = self.get_config("secret_key")
+        api_key = key.credential["api_key"]
+        secret_key = key.credential["secret_key"]
 
         url = f"https://aip.baidubce.com/oauth/2.0/token?grant_type=client_credentials&client_id={api_key}&client_secret={secret_key}"
 
         # post request
-        access_token_response_str = await http_requests.post(url)
+        access_token_response_str = await asyncio.wait_for(http_requests.post(url), time_left(deadline))
 
         try:
             access_token_response_json = json.loads(access_token_response_str)
             if "error" in access_token_response_json:
                 self.debug_log(f"fail to get access token, error: {access_token_response_json['error']}")
+                self.key_pool.park(key, "auth")
                 return None
             else:
                 access_token = access_token_response_json["access_token"]
                 expire_time = time.time() + access_token_response_json["expires_in"] - 3600 * 24 * 10 # 提前10天
+                access_token_json = {"access_token":access_token,"expire_time":expire_time}
                 access_token_meta = AmiyaBotBLMLibraryMetaStorageModel.get_or_none(AmiyaBotBLMLibraryMetaStorageModel.key == access_token_key)
                 if access_token_meta:
-                    access_token_meta.meta_str = json.dumps({"access_token":access_token,"expire_time":expire_time})
+                    access_token_meta.meta_str = json.dumps(access_token_json)
                     access_token_meta.save()
                     self.debug_log(f"update access token: {access_token_meta.meta_str}")
                 else:
-                    access_token_meta = AmiyaBotBLMLibraryMetaStorageModel(key=access_token_key,meta_str=json.dumps({"access_token":access_token,"expire_time":expire_time}))
+                    access_token_meta = AmiyaBotBLMLibraryMetaStorageModel(key=access_token_key,meta_str=json.dumps(access_token_json))
                     access_token_meta.save()
+                self.access_tokens[appid] = access_token_json
                 return access_token
         except Exception as e:
             self.debug_log(f"fail to get access token, error: {e}")
             return None
 
-    def __pick_prompt(self, prompts: list, max_chars=4000) -> list:
+    def __embed_batch_function(self, model: str):
+        return lambda batch, batch_channel_ids: self.__embed_batch(model, batch, batch_channel_ids)
 
-        text_counter = ""
+    async def __embed_batch(self, model: str, texts: List[str], channel_ids: List[Optional[str]]) -> Optional[List[List[float]]]:
+        # 批次在后台发送，调用方超时后也可能仍在进行，计入inflight，适配器被替换后要等它结束才关闭
+        self.inflight += 1
+        try:
+            return await self.__send_embed_batch(model, texts, channel_ids)
+        finally:
+            self.inflight -= 1
+
+    async def __send_embed_batch(self, model: str, texts: List[str], channel_ids: List[Optional[str]]) -> Optional[List[List[float]]]:
+        key_pool = self.__get_key_pool()
+        key = key_pool.acquire()
+        if key is None:
+            self.debug_log('all credentials are parked')
+            return None
 
-        for i in range(1, len(prompts) + 1):
-            context = prompts[-i]
-            text_counter = context["content"] + text_counter
-            if len(text_counter) > max_chars:
-                return prompts[-i + 1 :]
-        
-        return prompts
+        try:
+            access_token = await self.__get_access_token(key)
+            if not access_token:
+                return None
+
+            url = "https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/embeddings/embedding-v1?access_token=" + access_token
+
+            headers = {
+                "Content-Type":"application/json"
+            }
+
+            response_str = await http_requests.post(url, headers=headers, payload={"input": texts})
+        finally:
+            key_pool.release(key)
+
+        try:
+            response_json = json.loads(response_str)
+
+            if "error_code" in response_json:
+                self.debug_log(f"fail to embed, error: {response_json['error_msg']} \n {response_str}")
+                self.__park_key_on_error(key_pool, key, response_json['error_code'])
+                return None
+
+            vectors = [item["embedding"] for item in sorted(response_json["data"], key=lambda item: item["index"])]
+            usage = response_json["usage"]
+            id = response_json["id"]
+        except Exception as e:
+            self.debug_log(f"fail to embed, error: {e} \n response: {response_str}")
+            return None
+
+        key_pool.record_usage(key, int(usage['prompt_tokens']), 0, int(usage['total_tokens']))
+
+        # 批次中的文本可能来自多个频道，每个频道按分摊到的用量各记一行
+        prompt_shares = split_usage(texts, channel_ids, int(usage['prompt_tokens']))
+        total_shares = split_usage(texts, channel_ids, int(usage['total_tokens']))
+        for channel_id, total_tokens in total_shares.items():
+            usage_row = AmiyaBotBLMLibraryTokenConsumeModel.create(
+                channel_id=channel_id, model_name=model, exec_id=id,
+                prompt_tokens=prompt_shares[channel_id],
+                completion_tokens=0,
+                total_tokens=total_tokens, exec_time=datetime.now())
+            # 写入数据库之后再计入预算，对账时按行号去重
+            token_budget.record(channel_id, model, total_tokens, usage_row.id)
+
+        return vectors
+
+    async def embedding_flow(
+        self,
+        texts: Union[str, List[str]],
+        model: Optional[Union[str, dict]] = None,
+        channel_id: Optional[str] = None,
+        deadline: Optional[float] = None,
+    ) -> Optional[List[List[float]]]:
+        model_info = self.get_model(model)
+        if model_info is None or "embedding_flow" not in model_info["supported_feature"]:
+            self.debug_log(f'model {model} not supported embedding_flow')
+            mark_local_rejection("unsupported")
+            return None
+
+        if not self.__get_key_pool().has_available():
+            self.debug_log('all credentials are parked')
+            mark_local_rejection("keys_parked")
+            return None
+
+        if isinstance(texts, str):
+            texts = [texts]
+
+        batcher = self.embedding_batchers.get(model)
+        if batcher is None:
+            # embedding-v1单次最多支持16条文本
+            batcher = EmbeddingBatcher(EmbeddingCache(self.cache_dir, model),
+                                       self.__embed_batch_function(model),
+                                       max_batch=16,
+                                       request_timeout=self.plugin.get_config("timeout") or None)
+            self.embedding_batchers[model] = batcher
+
+        return await batcher.embed(texts, channel_id, deadline)
+
+    async def warm_up(self) -> dict:
+        # 提前获取每个应用的access token，第一次对话就不必再等待
+        start_time = time.monotonic()
+        keys = self.__get_key_pool().keys
+        fetched = 0
+        for key in keys:
+            if await self.__get_access_token(key):
+                fetched += 1
+        return {"access_token": f"{fetched}/{len(keys)} {(time.monotonic() - start_time) * 1000:.0f}ms"}
+
+    def __pick_prompt(self, prompts: list, model_info: dict) -> list:
+        return token_counter.pick_messages(prompts, model_info["max-token"], model_info["model_name"])
 
     async def chat_flow(  
         self,  
@@ -158,11 +336,14 @@ class ERNIEAdapter(BLMAdapter):
         context_id: Optional[str] = None,  
         channel_id: Optional[str] = None,
         functions: Optional[List[BLMFunctionCall]] = None,  
+        deadline: Optional[float] = None,
+        ephemeral_prompt: Optional[List[str]] = None,
         ) -> Optional[str]:
         
-        access_token = await self.__get_access_token(channel_id)
-
-        if not access_token:
+        model_info = self.get_model(model)
+        if model_info is None:
+            self.debug_log(f"model {model} not supported")
+            mark_local_rejection("unsupported")
             return None
 
         if isinstance(prompt, str):
@@ -170,58 +351,75 @@ class ERNIEAdapter(BLMAdapter):
         
         # 百度对Message的要求比较奇葩
         # 必须为奇数个成员，成员中message的role必须依次为user、assistant
-        # 所以用户的提交必须合并
+        # 所以用户的提交必须合并。会话中按条保存，发送前再合并，
+        # 这样各个对话共同的人设等前缀只在消息存储中保存一份
 
-        big_prompt = "\n".join(prompt)
+        new_messages = [{"role": "user", "content": command} for command in prompt]
+        ephemeral_messages = [{"role": "user", "content": command} for command in ephemeral_prompt or []]
 
-        prompt = [{"role": "user", "content": big_prompt}]
+        if model not in MODEL_URL_MAP:
+            self.debug_log(f"model {model} not supported")
+            mark_local_rejection("unsupported")
+            return None
 
-        if context_id is not None:
-            if context_id not in self.context_holder:
-                self.context_holder[context_id] = []
-            prompt = self.context_holder[context_id] + prompt
-        
-        # 以防万一，进行一个检查，如果prompt列表不是 user 和 assistant 交替出现，
-        # 那么就从集合抽出有问题的项目并报日志
-
-        expected_roles = ['user', 'assistant']
-
-        # 当列表中至少有两个元素时循环检查
-        while len(prompt) > 1:
-            # 检查列表中的每个元素
-            for i in range(len(prompt) - 1):
-                # 如果当前元素和下一个元素的角色相同或者不符合期望的顺序
-                if prompt[i]['role'] == prompt[i + 1]['role'] or prompt[i]['role'] != expected_roles[i % 2]:
-                    self.debug_log(f"prompt list order error, remove prompt: {prompt[i]}")
-                    del prompt[i]
-                    break
+        # 同一个context的请求按顺序执行，避免并发时互相覆盖对话记录
+        session = self.sessions.get(context_id)
+        async with session.lock:
+            return await self.__send_chat(model, model_info, session, ephemeral_messages, new_messages, channel_id, deadline)
+
+    def __merge_user_messages(self, prompt: List[dict]) -> List[dict]:
+        # 连续的user消息来自同一次提交，合并为一条
+        merged = []
+        for message in prompt:
+            if merged and message['role'] == 'user' and merged[-1]['role'] == 'user':
+                merged[-1] = {"role": "user", "content": merged[-1]['content'] + "\n" + message['content']}
             else:
-                # 如果所有元素都符合条件，则退出循环
-                break
+                merged.append(message)
+        return merged
 
-        # 百度的API不需要检测字数，但是为了减少网络流量，这里限制到4000个字。
-        # 从后向前计算content的累计字数，砍掉超过4000字的部分，直到字数小于4000
+    def __repair_alternation(self, prompt: List[dict]) -> List[dict]:
+        # 以防万一，进行一个检查，如果prompt列表不是 user 和 assistant 交替出现，
+        # 那么就从集合抽出有问题的项目并报日志。只需要从前往后扫描一遍：
+        # 多出来的assistant直接丢弃，连续的user只保留后一个
+        repaired = []
+        for message in prompt:
+            expected_role = 'user' if len(repaired) % 2 == 0 else 'assistant'
+            if message['role'] == expected_role:
+                repaired.append(message)
+            elif message['role'] == 'user':
+                self.debug_log(f"prompt list order error, remove prompt: {repaired[-1]}")
+                repaired[-1] = message
+            else:
+                self.debug_log(f"prompt list order error, remove prompt: {message}")
+        return repaired
+
+    async def __send_chat(self, model: str, model_info: dict, session: ChatSession, ephemeral_messages: List[dict],
+                          new_messages: List[dict], channel_id: Optional[str], deadline: Optional[float]) -> Optional[str]:
+        # 发送前先离线估算token，从后向前累计，砍掉超过max-token的部分
+        # ephemeral_messages只随本次请求发送，不写入会话
+
+        prompt = session.window(ephemeral_messages + new_messages, model_info["max-token"], model)
+        if prompt is None:
+            self.debug_log(f"prompt exceeds max-token of {model}")
+            mark_local_rejection("max_token")
+            return None
+        prompt = self.__merge_user_messages(prompt)
+        prompt = self.__repair_alternation(prompt)
+        prompt = self.__pick_prompt(prompt, model_info)
 
-        prompt = self.__pick_prompt(prompt, 4000)
+        if len(prompt) == 0:
+            self.debug_log(f"prompt exceeds max-token of {model}")
+            mark_local_rejection("max_token")
+            return None
 
         if len(prompt) % 2 != 1:
             self.debug_log(f"prompt list is not odd, prompt: {prompt}")
             # 移除第一个元素，使其变为奇数
             del prompt[0]
-        
-        # Post调用
 
-        model_url_map = {
-            "ERNIE-Bot 4.0":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions_pro",
-            "ERNIE-Bot":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/completions",
-            "ERNIE-Bot-turbo":"https://aip.baidubce.com/rpc/2.0/ai_custom/v1/wenxinworkshop/chat/eb-instant"
-        }
-
-        if model not in model_url_map:
-            self.debug_log(f"model {model} not supported")
-            return None
+        estimated_tokens = token_counter.count_raw(prompt)
         
-        url = model_url_map[model] + "?access_token=" + access_token
+        # Post调用
 
         headers = {
             "Content-Type":"application/json"
@@ -236,13 +434,35 @@ class ERNIEAdapter(BLMAdapter):
             ]
         }
 
-        response_str = await http_requests.post(url, headers=headers, payload=data)
+        key_pool = self.__get_key_pool()
+        key = key_pool.acquire()
+        if key is None:
+            self.debug_log('all credentials are parked')
+            mark_local_rejection("keys_parked")
+            return None
+
+        self.debug_log(f"use api key: {key.name}")
+
+        try:
+            access_token = await self.__get_access_token(key, deadline)
+
+            if not access_token:
+                return None
+
+            url = MODEL_URL_MAP[model] + "?access_token=" + access_token
+
+            response_str = await asyncio.wait_for(http_requests.post(url, headers=headers, payload=data), time_left(deadline))
+        finally:
+            key_pool.release(key)
 
         try:
             response_json = json.loads(response_str)
 
             if "error_code" in response_json:
                 self.debug_log(f"fail to chat, error: {response_json['error_msg']} \n {response_str}")
+                self.__park_key_on_error(key_pool, key, response_json['error_code'])
+                if response_json['error_code'] in ACCESS_TOKEN_ERROR_CODES:
+                    mark_local_rejection("access_token")
                 return None
 
             # 校验和取值
@@ -277,14 +497,17 @@ class ERNIEAdapter(BLMAdapter):
             file.write(f'{result}')
             file.write('\n')
 
-        AmiyaBotBLMLibraryTokenConsumeModel.create(
+        token_counter.calibrate(model, estimated_tokens, int(usage['prompt_tokens']))
+        key_pool.record_usage(key, int(usage['prompt_tokens']), int(usage['completion_tokens']), int(usage['total_tokens']))
+
+        usage_row = AmiyaBotBLMLibraryTokenConsumeModel.create(
             channel_id=channel_id, model_name=model, exec_id=id,
             prompt_tokens=int(usage['prompt_tokens']),
             completion_tokens=int(usage['completion_tokens']),
             total_tokens=int(usage['total_tokens']), exec_time=datetime.now())
+        # 写入数据库之后再计入预算，对账时按行号去重
+        token_budget.record(channel_id, model, int(usage['total_tokens']), usage_row.id)
         
-        if context_id is not None:
-            prompt.append({"role": "assistant", "content": result})
-            self.context_holder[context_id] = prompt
+        session.append_turn(new_messages + [{"role": "assistant", "content": result}])
 
         return f"{result}".strip()
\ No newline at end of file